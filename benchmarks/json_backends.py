@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+"""
+Compare the JSON backends supported by `ninette.jsonlib` on recorded payloads,
+e.g. NINA detail messages saved with:
+
+    curl -o warning.json https://warnung.bund.de/api31/warnings/<identifier>.json
+
+Usage: python benchmarks/json_backends.py [-n NUMBER] FILE...
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+
+
+def output(line):
+    sys.stdout.write(f'{line}\n')
+
+
+def get_backends():
+    backends = {
+        'json': (
+            json.loads,
+            lambda obj: json.dumps(obj, sort_keys=True, indent=2, ensure_ascii=False)
+            .encode('utf-8')),
+    }
+    try:
+        import orjson  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        backends['orjson'] = (
+            orjson.loads,
+            lambda obj: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2))
+    try:
+        import ujson  # noqa: PLC0415
+    except ImportError:
+        pass
+    else:
+        backends['ujson'] = (
+            ujson.loads,
+            lambda obj: ujson.dumps(obj, sort_keys=True, indent=2, ensure_ascii=False,
+                                    escape_forward_slashes=False).encode('utf-8'))
+
+    return backends
+
+
+def benchmark(payloads, number):
+    documents = [json.loads(payload) for payload in payloads]
+    output(f'{len(payloads)} payloads, {sum(map(len, payloads))} bytes, {number} iterations')
+    output(f'{"backend":<10} {"decode (ms)":>12} {"encode (ms)":>12}')
+    for name, (loads, dumps) in get_backends().items():
+        decode_time = timeit.timeit(lambda: [loads(payload) for payload in payloads],  # noqa: B023
+                                    number=number)
+        encode_time = timeit.timeit(lambda: [dumps(document) for document in documents],  # noqa: B023
+                                    number=number)
+        output(f'{name:<10} {decode_time * 1000:>12.1f} {encode_time * 1000:>12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JSON backends')
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='Number of iterations (default: 1000)')
+    parser.add_argument('files', nargs='+', type=Path, help='Recorded JSON payloads')
+    arguments = parser.parse_args()
+
+    payloads = [path.read_bytes() for path in arguments.files]
+    benchmark(payloads, arguments.number)
+
+
+if __name__ == '__main__':
+    main()
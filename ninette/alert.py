@@ -2,13 +2,102 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE file for details.
 
-import json
+import os
+import shutil
+import weakref
+from functools import partial
+from pathlib import Path
+from tempfile import mkstemp
+from threading import Lock
+
+from ninette import jsonlib
+
+
+# attachments larger than this are kept in a temporary file instead of memory
+ATTACHMENT_SPILL_SIZE = 256 * 1024
+
+
+def _spill_to_file(content, directory):
+    file_descriptor, path = mkstemp(prefix='ninette_', dir=directory)
+    path = Path(path)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as spill_file:
+            spill_file.write(content)
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+class Attachment:
+    """
+    File attached to an alert, `content` might be given as callable returning the bytes
+    to render it only when it is accessed the first time (e.g. by an alerter which consumes it).
+
+    Content larger than `ATTACHMENT_SPILL_SIZE` is spilled to a temporary file in
+    `spill_directory` (the system's temporary directory if None) and read again on access,
+    so many alerts waiting for slow alerters do not keep all their attachments (e.g. map images)
+    in memory. The file is removed once the attachment is garbage collected.
+    """
+
+    __slots__ = ('__weakref__', '_content', '_lock', '_path', '_spill_directory', 'filename',
+                 'mimetype', 'original_event')
+
+    def __init__(self, filename, content, mimetype, original_event=False,  # noqa: FBT002
+                 spill_directory=None):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.original_event = original_event
+        self._content = None
+        self._path = None
+        self._spill_directory = spill_directory
+        self._lock = Lock()
+        if callable(content):
+            self._content = content
+        else:
+            self._store_content(content)
+
+    @property
+    def content(self):
+        with self._lock:
+            if callable(self._content):
+                content = self._content()
+                self._store_content(content)
+                return content
+            if self._path is not None:
+                return self._path.read_bytes()
+            return self._content
+
+    def write_to_file(self, path):
+        """ Write the content to `path`, spilled content is copied without reading it at once """
+        with self._lock:
+            if self._path is not None:
+                shutil.copyfile(self._path, path)
+                return
+
+        path.write_bytes(self.content)
+
+    def _store_content(self, content):
+        self._content = content
+        if len(content) <= ATTACHMENT_SPILL_SIZE:
+            return
+
+        try:
+            self._path = _spill_to_file(content, self._spill_directory)
+        except OSError:
+            return  # spilling is only an optimization, keep the content in memory
+        self._content = None
+        # keep no open file per attachment, just remove the file once it is not needed anymore
+        weakref.finalize(self, self._path.unlink, missing_ok=True)
 
 
 class Alert:
 
+    __slots__ = ('_attachments_directory', 'alert_type', 'attachments', 'expire_date',
+                 'identifier', 'outbox_id', 'provider_name', 'text', 'title')
+
     def __init__(self, provider_name, identifier, title, text=None,
-                 alert_type=None, expire_date=None):
+                 alert_type=None, expire_date=None, attachments_directory=None):
         self.provider_name = provider_name
         self.identifier = identifier
         self.alert_type = alert_type
@@ -16,15 +105,27 @@ class Alert:
         self.title = title
         self.text = text
         self.attachments = []
+        self.outbox_id = None  # set once the alert is stored in the outbox, see `Outbox`
+        # large attachments are spilled to this directory, see `Attachment`
+        self._attachments_directory = attachments_directory
+
+    @property
+    def key(self):
+        """ Identifies the alert in the database, see `Database.get_processed_alerts()` """
+        return (self.identifier, self.alert_type, self.provider_name)
 
     def attach_original_event(self, original_event):
-        formatted_original_json = json.dumps(original_event, sort_keys=True, indent=2)
-        formatted_original_json_bytes = formatted_original_json.encode('utf-8')
+        # format the JSON only if any alerter actually uses it
+        formatted_original_json_bytes = partial(jsonlib.dumps, original_event, sort_keys=True,
+                                                indent=True)
         filename = self._factor_original_event_filename()
         self.add_attachment(filename, formatted_original_json_bytes, 'text/plain')
 
     def add_attachment(self, filename, content, mimetype):
-        self.attachments.append((filename, content, mimetype))
+        """ Add an attachment, `content` is either bytes or a callable returning them """
+        original_event = self.is_attachment_filename_original_event(filename)
+        self.attachments.append(Attachment(filename, content, mimetype, original_event,
+                                           self._attachments_directory))
 
     def is_attachment_filename_original_event(self, filename):
         expected_filename = self._factor_original_event_filename()
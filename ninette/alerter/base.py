@@ -9,6 +9,44 @@ from ninette.module import ModuleBase
 
 class AlerterBase(ModuleBase):
 
+    def __init__(self, config):
+        super().__init__(config)
+        self._attachment_store = None
+        self._outbox = None
+        # alerters without this setting get the original event attachments as well
+        self.attach_original_event = True
+
+    def set_attachment_store(self, attachment_store):
+        self._attachment_store = attachment_store
+
+    def set_outbox(self, outbox):
+        self._outbox = outbox
+
+    def consumes_attachment(self, attachment):
+        """
+        Return whether the alerter uses `attachment`, the content of attachments not used by
+        any alerter is neither rendered nor stored
+        """
+        # ignore the original event JSON if not enabled
+        return self.attach_original_event or not attachment.original_event
+
     @abstractmethod
     def process(self, alerts):
+        """
+        Return the list of successfully processed alerts or None if all alerts were processed
+        successfully, the other alerts are processed again later
+        """
         raise NotImplementedError
+
+    def _get_delivered_targets(self, alert):
+        """
+        Return the targets (e.g. mail recipients) the alert was already delivered to by
+        a previous, partially failed attempt
+        """
+        if self._outbox is None:
+            return set()
+        return self._outbox.get_delivered_targets(self, alert)
+
+    def _mark_target_as_delivered(self, alert, target):
+        if self._outbox is not None:
+            self._outbox.add_delivered_target(self, alert, target)
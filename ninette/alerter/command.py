@@ -3,11 +3,13 @@
 # of the MIT license.  See the LICENSE file for details.
 
 import contextlib
+import os
+import signal
 import subprocess
-from pathlib import Path
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
 
 from ninette.alerter.base import AlerterBase
+from ninette.attachment_store import AttachmentStore
 
 
 class CommandAlerterError(Exception):
@@ -16,11 +18,14 @@ class CommandAlerterError(Exception):
 
 class CommandAlerter(AlerterBase):
 
-    def __init__(self, config, command, alert_text_via_stdin, attach_original_event):
+    def __init__(self, config, command, alert_text_via_stdin,
+                 attach_original_event, max_concurrent_commands, command_timeout):
         super().__init__(config)
         self.command = command
         self.alert_text_via_stdin = alert_text_via_stdin
         self.attach_original_event = attach_original_event
+        self.max_concurrent_commands = max_concurrent_commands
+        self.command_timeout = command_timeout
 
     @classmethod
     def create_from_config(cls, config, config_parser, section_name):
@@ -32,23 +37,40 @@ class CommandAlerter(AlerterBase):
         attach_original_event = config_parser.getboolean(
             section_name, 'attach_original_event', fallback=False)
 
-        instance = cls(config, command, alert_text_via_stdin, attach_original_event)
+        max_concurrent_commands = config_parser.getint(
+            section_name, 'max_concurrent_commands', fallback=1)
+        if max_concurrent_commands < 1:
+            errmsg = (f'Invalid max_concurrent_commands {max_concurrent_commands} in section '
+                      f'"{section_name}", it must be at least 1')
+            raise ValueError(errmsg)
+
+        command_timeout = config_parser.getfloat(section_name, 'command_timeout', fallback=300)
+
+        instance = cls(config, command, alert_text_via_stdin, attach_original_event,
+                       max_concurrent_commands, command_timeout)
         return instance
 
     def process(self, alerts):
         if not alerts:
-            return
-
-        for alert in alerts:
-            try:
-                self._process_alert(alert)
-            except Exception as exc:
-                self._logger.error(
-                    'Error while executing command for alert "%s": %s', alert.identifier, exc)
-
+            return None
+
+        delivered_alerts = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_commands,
+                                thread_name_prefix=self.__class__.__name__) as executor:
+            futures = [(alert, executor.submit(self._process_alert, alert)) for alert in alerts]
+            for alert, future in futures:
+                try:
+                    future.result()
+                except Exception as exc:
+                    self._logger.error(
+                        'Error while executing command for alert "%s": %s', alert.identifier, exc)
+                else:
+                    delivered_alerts.append(alert)
+
+        return delivered_alerts
 
     def _process_alert(self, alert):
-        attachments_filenames = self._create_attachments_temporary_files(alert)
+        attachments_filenames = self._acquire_attachment_files(alert)
         try:
             # process placeholders
             command = self.command.format(
@@ -71,49 +93,65 @@ class CommandAlerter(AlerterBase):
             self._logger.info('Successfully executed command "%s" for alert "%s". Output: %s',
                               command_for_log, alert.identifier, output)
         finally:
-            self._remove_temporary_files(attachments_filenames)
+            self._release_attachment_files(alert)
+
+    def _acquire_attachment_files(self, alert):
+        if self._attachment_store is None:
+            # the store is usually set by NinetteRunner, create our own if not
+            self._attachment_store = AttachmentStore()
 
-    def _create_attachments_temporary_files(self, alert):
         attachments_filenames = []
-        for attachment_filename, attachment_content, _ in alert.attachments:
-            # ignore the original event JSON if not enabled
-            if not self.attach_original_event \
-                    and alert.is_attachment_filename_original_event(attachment_filename):
-                continue
+        try:
+            for attachment in self._get_attachments(alert):
+                attachment_path = self._attachment_store.acquire_file(attachment)
+                attachments_filenames.append(attachment_path)
+        except Exception:
+            self._release_attachment_files(alert, len(attachments_filenames))
+            raise
 
-            temp_file_suffix = f'ninette_{attachment_filename}'
-            with NamedTemporaryFile(suffix=temp_file_suffix, delete=False) as temp_file:
-                temp_file.write(attachment_content)
+        return attachments_filenames
 
-            attachments_filenames.append(temp_file.name)
+    def _release_attachment_files(self, alert, attachment_count=None):
+        attachments = self._get_attachments(alert)[:attachment_count]
+        for attachment in attachments:
+            self._attachment_store.release_file(attachment)
 
-        return attachments_filenames
+    def _get_attachments(self, alert):
+        return [attachment for attachment in alert.attachments
+                if self.consumes_attachment(attachment)]
 
     def _execute_command(self, command, alert_text_stdin):
         if self._config.dry_run:
             return 'dry-run activate, command was not executed.'
 
-        try:
-            output_bytes = subprocess.check_output(command, shell=True,  # noqa: S602
-                                                   input=alert_text_stdin, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            output = self._process_command_output(exc.output)
-            command_for_log = f'{command[:60]}...'
-            exit_code = exc.returncode
+        command_for_log = f'{command[:60]}...'
+        stdin = subprocess.PIPE if alert_text_stdin is not None else None
+        # start the command in a new session, so it can be killed with all its child processes
+        with subprocess.Popen(command, shell=True, stdin=stdin,  # noqa: S602
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              start_new_session=True) as process:
+            try:
+                output_bytes, _ = process.communicate(alert_text_stdin,
+                                                      timeout=self.command_timeout)
+            except subprocess.TimeoutExpired as exc:
+                self._kill_process_group(process)
+                process.communicate()
+                msg = f'Command "{command_for_log}" timed out after {self.command_timeout} seconds'
+                raise CommandAlerterError(msg) from exc
+
+        if process.returncode != 0:
+            output = self._process_command_output(output_bytes)
+            exit_code = process.returncode
             msg = f'Command "{command_for_log}" failed with exit code {exit_code}. Output: {output}'
-            raise CommandAlerterError(msg) from exc
+            raise CommandAlerterError(msg)
 
         return self._process_command_output(output_bytes)
 
     @staticmethod
-    def _process_command_output(output_bytes):
-        return output_bytes.decode('utf-8').strip()
+    def _kill_process_group(process):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
 
     @staticmethod
-    def _remove_temporary_files(filenames):
-        if filenames is None:
-            return
-
-        for filename in filenames:
-            with contextlib.suppress(FileNotFoundError):
-                Path(filename).unlink()
+    def _process_command_output(output_bytes):
+        return output_bytes.decode('utf-8').strip()
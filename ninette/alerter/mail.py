@@ -4,6 +4,7 @@
 
 import smtplib
 from email.message import EmailMessage
+from email.policy import SMTP
 from email.utils import formatdate
 
 from ninette.alerter.base import AlerterBase
@@ -17,7 +18,8 @@ class EmailAlerterSMTPError(Exception):
 class EmailAlerter(AlerterBase):
 
     def __init__(self, config, recipients, from_address, smtp_server, smtp_port,  # noqa: PLR0913
-                 smtp_username, smtp_password, smtp_use_tls, attach_original_event):
+                 smtp_username, smtp_password, smtp_use_tls, attach_original_event,
+                 combine_recipients):
         super().__init__(config)
         self.from_address = from_address
         self.recipients = recipients.split(',')
@@ -27,6 +29,8 @@ class EmailAlerter(AlerterBase):
         self.smtp_password = smtp_password
         self.smtp_use_tls = smtp_use_tls
         self.attach_original_event = attach_original_event
+        self.combine_recipients = combine_recipients
+        self._connection = None
 
     @classmethod
     def create_from_config(cls, config, config_parser, section_name):
@@ -39,20 +43,32 @@ class EmailAlerter(AlerterBase):
         smtp_use_tls = config_parser.getboolean(section_name, 'smtp_use_tls', fallback=True)
         attach_original_event = config_parser.getboolean(
             section_name, 'attach_original_event', fallback=True)
+        combine_recipients = config_parser.getboolean(
+            section_name, 'combine_recipients', fallback=False)
         instance = cls(config, recipients, from_address, smtp_server, smtp_port,
-                       smtp_username, smtp_password, smtp_use_tls, attach_original_event)
+                       smtp_username, smtp_password, smtp_use_tls, attach_original_event,
+                       combine_recipients)
         return instance
 
     def process(self, alerts):
         if not alerts:
-            return
+            return None
 
-        for alert in alerts:
-            try:
-                self._process_alert(alert)
-            except Exception as exc:
-                self._logger.error('Error while sending emails for alert "%s": %s',
-                                   alert.identifier, exc)
+        delivered_alerts = []
+        # use one SMTP connection for all alerts and recipients
+        try:
+            for alert in alerts:
+                try:
+                    self._process_alert(alert)
+                except Exception as exc:
+                    self._logger.error('Error while sending emails for alert "%s": %s',
+                                       alert.identifier, exc)
+                else:
+                    delivered_alerts.append(alert)
+        finally:
+            self._disconnect()
+
+        return delivered_alerts
 
     def _process_alert(self, alert):
         email_message = EmailMessage()
@@ -60,43 +76,105 @@ class EmailAlerter(AlerterBase):
         email_message['Subject'] = f'[Ninette] {alert.title}'
         email_message['From'] = self.from_address
         email_message['Date'] = formatdate(localtime=True)
-        email_message['To'] = ''  # will be set below
         email_message['X-Mailer'] = APP_NAME_VERSION
 
-        for filename, content, mimetype in alert.attachments:
-            # ignore the original event JSON if not enabled
-            if not self.attach_original_event \
-                    and alert.is_attachment_filename_original_event(filename):
+        for attachment in alert.attachments:
+            if not self.consumes_attachment(attachment):
                 continue
 
-            mimetype_main, mimetype_sub = mimetype.split('/', 1)
-            email_message.add_attachment(content, maintype=mimetype_main, subtype=mimetype_sub,
-                                         filename=filename)
+            mimetype_main, mimetype_sub = attachment.mimetype.split('/', 1)
+            email_message.add_attachment(attachment.content, maintype=mimetype_main,
+                                         subtype=mimetype_sub, filename=attachment.filename)
+
+        # serialize the message including the encoded attachments only once for all recipients,
+        # only the "To" header is added per recipient
+        message_bytes = email_message.as_bytes(policy=SMTP)
+
+        if self.combine_recipients:
+            recipients = ', '.join(self.recipients)
+            self._logger.info('Sending alert "%s" mail to "%s"', alert.identifier, recipients)
+            self._send_mail(self.recipients, self._add_to_header(message_bytes, recipients))
+            return
 
+        # on retries, send the mail only to the recipients which failed before
+        delivered_recipients = self._get_delivered_targets(alert)
+        failed_recipients = []
         for recipient in self.recipients:
+            if recipient in delivered_recipients:
+                self._logger.debug('Skipping alert "%s" mail to "%s", already sent',
+                                   alert.identifier, recipient)
+                continue
+
             self._logger.info('Sending alert "%s" mail to "%s"', alert.identifier, recipient)
-            email_message.replace_header('To', recipient)
-            self._send_mail(recipient, email_message)
+            try:
+                self._send_mail([recipient], self._add_to_header(message_bytes, recipient))
+            except EmailAlerterSMTPError as exc:
+                self._logger.error('Error while sending email for alert "%s": %s',
+                                   alert.identifier, exc)
+                failed_recipients.append(recipient)
+            else:
+                self._mark_target_as_delivered(alert, recipient)
+
+        if failed_recipients:
+            recipients_for_log = ', '.join(failed_recipients)
+            errmsg = f'Unable to send email to "{recipients_for_log}"'
+            raise EmailAlerterSMTPError(errmsg)
 
-    def _send_mail(self, recipient, email_message):
+    @staticmethod
+    def _add_to_header(message_bytes, recipients):
+        to_header = SMTP.header_factory('To', recipients)
+        return SMTP.fold_binary('To', to_header) + message_bytes
+
+    def _send_mail(self, recipients, message_bytes):
         if self._config.dry_run:
             return
 
         try:
+            try:
+                self._send_mail_via_connection(recipients, message_bytes)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # the server might have closed the connection in the meantime, try once again
+                self._disconnect()
+                self._send_mail_via_connection(recipients, message_bytes)
+        except OSError as exc:
+            # start with a fresh connection for the next mail
+            self._disconnect()
+            recipients_for_log = ', '.join(recipients)
+            errmsg = f'Unable to send email to "{recipients_for_log}": {exc}'
+            raise EmailAlerterSMTPError(errmsg) from exc
+
+    def _send_mail_via_connection(self, recipients, message_bytes):
+        connection = self._connect()
+        response = connection.sendmail(self.from_address, recipients, message_bytes)
+        if response:
+            for failed_recipient, error in response.items():
+                errmsg = f'Unable to send email to "{failed_recipient}": {error}'
+                raise EmailAlerterSMTPError(errmsg)
+
+    def _connect(self):
+        if self._connection is None:
             smtp_class = smtplib.SMTP_SSL if self.smtp_use_tls else smtplib.SMTP
             connection = smtp_class(self.smtp_server, self.smtp_port)
-            connection.ehlo()
-            if connection.has_extn('STARTTLS'):
-                connection.starttls()
-            if self.smtp_username and self.smtp_password:
-                connection.login(self.smtp_username, self.smtp_password)
-
-            response = connection.send_message(email_message, self.from_address, [recipient])
-            if response:
-                for failed_recipient, error in response.items():
-                    errmsg = f'Unable to send email to "{failed_recipient}": {error}'
-                    raise EmailAlerterSMTPError(errmsg)
+            try:
+                connection.ehlo()
+                if connection.has_extn('STARTTLS'):
+                    connection.starttls()
+                if self.smtp_username and self.smtp_password:
+                    connection.login(self.smtp_username, self.smtp_password)
+            except Exception:
+                connection.close()
+                raise
+            self._connection = connection
+
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is None:
+            return
+
+        connection = self._connection
+        self._connection = None
+        try:
             connection.quit()
-        except OSError as exc:
-            errmsg = f'Unable to send email to "{recipient}": {exc}'
-            raise EmailAlerterSMTPError(errmsg) from exc
+        except (smtplib.SMTPException, OSError):
+            connection.close()
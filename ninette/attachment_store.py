@@ -0,0 +1,100 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import logging
+import shutil
+from itertools import count
+from pathlib import Path
+from tempfile import mkdtemp
+from threading import Lock
+
+
+class AttachmentStore:
+    """
+    Stage alert attachments as files for alerters which need them on disk (e.g. CommandAlerter).
+
+    All files are created in a directory per Ninette process below `directory`
+    (e.g. the RAM-backed "/dev/shm", the default is the system's temporary directory).
+    Each attachment is written only once and reference-counted: NinetteRunner retains the
+    attachments of the alerts while they are passed to the alerters, so all alerters share the
+    same file which is removed once it has been released by all of them.
+
+    Entries are keyed by the attachment objects themselves, so attachments with the same
+    filename (e.g. of an alert retried from the outbox and the same alert fetched again)
+    never share a file.
+    """
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._path = None
+        self._files = {}
+        self._file_counter = count()
+        self._lock = Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def retain(self, alerts):
+        with self._lock:
+            for alert in alerts:
+                for attachment in alert.attachments:
+                    self._retain(attachment)
+
+    def release(self, alerts):
+        with self._lock:
+            for alert in alerts:
+                for attachment in alert.attachments:
+                    self._release(attachment)
+
+    def acquire_file(self, attachment):
+        """ Return the path of the file for the attachment, write it if not yet staged """
+        with self._lock:
+            entry = self._retain(attachment)
+            if entry['path'] is None:
+                try:
+                    entry['path'] = self._write_file(attachment)
+                except Exception:
+                    self._release(attachment)
+                    raise
+            return str(entry['path'])
+
+    def release_file(self, attachment):
+        with self._lock:
+            self._release(attachment)
+
+    def close(self):
+        with self._lock:
+            self._files = {}
+            if self._path is not None:
+                shutil.rmtree(self._path, ignore_errors=True)
+                self._path = None
+
+    def _retain(self, attachment):
+        # the entry references the attachment, so its ID is not reused while the entry exists
+        entry = self._files.get(id(attachment))
+        if entry is None:
+            entry = self._files[id(attachment)] = {'attachment': attachment, 'path': None,
+                                                   'references': 0}
+        entry['references'] += 1
+        return entry
+
+    def _release(self, attachment):
+        entry = self._files.get(id(attachment))
+        if entry is None:
+            return
+
+        entry['references'] -= 1
+        if entry['references'] <= 0:
+            del self._files[id(attachment)]
+            if entry['path'] is not None:
+                entry['path'].unlink(missing_ok=True)
+
+    def _write_file(self, attachment):
+        if self._path is None:
+            self._path = Path(mkdtemp(prefix='ninette_', dir=self._directory))
+            self._logger.debug('Staging attachments in "%s"', self._path)
+
+        # prefix the name with a counter as attachments of different alerts might use the same
+        # filename, keep the attachment's filename for the file extension
+        path = self._path / f'{next(self._file_counter)}_{Path(attachment.filename).name}'
+        attachment.write_to_file(path)
+        return path
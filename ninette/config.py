@@ -68,8 +68,25 @@ class NinetteConfigParser:
             fallback='%(asctime)s [%(levelname)+8s] [%(name)-24s] {dry_run}%(message)s')
         self._config.http_proxy = parser.get(section_name, 'http_proxy', fallback=None)
         self._config.http_useragent = parser.get(section_name, 'http_useragent', fallback=None)
+        self._config.http_pool_size = parser.getint(section_name, 'http_pool_size', fallback=10)
+        self._config.http_keep_alive = parser.getboolean(section_name, 'http_keep_alive',
+                                                         fallback=True)
+        self._config.http_retries = parser.getint(section_name, 'http_retries', fallback=3)
+        self._config.http_retry_backoff = parser.getfloat(section_name, 'http_retry_backoff',
+                                                          fallback=0.5)
         self._config.fetch_interval = parser.getint(section_name, 'fetch_interval', fallback=300)
+        self._config.fetch_jitter = parser.getfloat(section_name, 'fetch_jitter', fallback=10)
+        self._config.provider_timeout = parser.getfloat(section_name, 'provider_timeout',
+                                                        fallback=600)
+        self._config.alerter_queue_size = parser.getint(section_name, 'alerter_queue_size',
+                                                        fallback=10)
+        self._config.alerter_shutdown_timeout = parser.getfloat(
+            section_name, 'alerter_shutdown_timeout', fallback=300)
+        self._config.alerter_max_attempts = parser.getint(section_name, 'alerter_max_attempts',
+                                                          fallback=5)
         self._config.alerts_max_days = parser.getint(section_name, 'alerts_max_days', fallback=180)
+        self._config.attachments_directory = parser.get(section_name, 'attachments_directory',
+                                                        fallback=None)
 
         language_codes = self._config.language_codes.split(' ')
         self._config.language_codes = [code.lower().replace('-', '_') for code in language_codes]
@@ -85,7 +102,9 @@ class NinetteConfigParser:
         module_name, class_name = class_path.rsplit('.', 1)
         module = import_module(module_name)
         class_ = getattr(module, class_name, None)
-        return class_.create_from_config(self._config, self._config_parser, section_name)
+        instance = class_.create_from_config(self._config, self._config_parser, section_name)
+        instance.name = section_name
+        return instance
 
     def _override_config_options_from_command_line(self):
         self._config.fetch_interval = self._options.fetch_interval or self._config.fetch_interval
@@ -15,9 +15,19 @@ class Configuration:
     def __init__(self):
         self.database_filename = None
         self.fetch_interval = None
+        self.fetch_jitter = None
+        self.provider_timeout = None
+        self.alerter_queue_size = None
+        self.alerter_shutdown_timeout = None
+        self.alerter_max_attempts = None
         self.alerts_max_days = None
+        self.attachments_directory = None
         self.http_proxy = None
         self.http_useragent = None
+        self.http_pool_size = None
+        self.http_keep_alive = None
+        self.http_retries = None
+        self.http_retry_backoff = None
         self.timeout = None
         self.log_format = None
         self.language_codes = None
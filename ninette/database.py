@@ -5,6 +5,7 @@
 import sqlite3
 from contextlib import contextmanager
 from datetime import datetime, timezone
+from threading import RLock
 
 
 DATABASE_SCHEMA_STATEMENTS = [
@@ -20,92 +21,352 @@ DATABASE_SCHEMA_STATEMENTS = [
     'CREATE INDEX IF NOT EXISTS `idx_alert_provider` ON `alert` (`provider`);',
     'CREATE INDEX IF NOT EXISTS `idx_entry_date` ON `alert` (`entry_date`);',
     'CREATE INDEX IF NOT EXISTS `idx_expire_date` ON `alert` (`expire_date`);',
-    'CREATE UNIQUE INDEX IF NOT EXISTS `idx_alert` ON `alert` (`alert_id`, `alert_type`, `provider`);'  # noqa: E501
+    'CREATE UNIQUE INDEX IF NOT EXISTS `idx_alert` ON `alert` (`alert_id`, `alert_type`, `provider`);',  # noqa: E501
+    '''
+    CREATE TABLE IF NOT EXISTS `http_cache` (
+    `url`               TEXT NOT NULL PRIMARY KEY,
+    `etag`              TEXT,
+    `last_modified`     TEXT,
+    `content_hash`      TEXT NOT NULL,
+    `update_date`       DATETIME NOT NULL);
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS `provider_state` (
+    `provider`          TEXT NOT NULL PRIMARY KEY,
+    `state`             TEXT NOT NULL,
+    `update_date`       DATETIME NOT NULL);
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS `outbox` (
+    `outbox_id`         INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    `alert_id`          TEXT NOT NULL,
+    `alert_type`        TEXT,
+    `provider`          TEXT NOT NULL,
+    `title`             TEXT NOT NULL,
+    `text`              TEXT,
+    `expire_date`       DATETIME,
+    `entry_date`        DATETIME NOT NULL);
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS `outbox_attachment` (
+    `outbox_id`         INTEGER NOT NULL,
+    `position`          INTEGER NOT NULL,
+    `filename`          TEXT NOT NULL,
+    `content`           BLOB NOT NULL,
+    `mimetype`          TEXT NOT NULL,
+    PRIMARY KEY (`outbox_id`, `position`));
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS `outbox_delivery` (
+    `outbox_id`         INTEGER NOT NULL,
+    `alerter`           TEXT NOT NULL,
+    `attempts`          INTEGER NOT NULL DEFAULT 0,
+    `next_attempt_date` DATETIME,
+    PRIMARY KEY (`outbox_id`, `alerter`));
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS `outbox_delivered_target` (
+    `outbox_id`         INTEGER NOT NULL,
+    `alerter`           TEXT NOT NULL,
+    `target`            TEXT NOT NULL,
+    PRIMARY KEY (`outbox_id`, `alerter`, `target`));
+    ''',
 ]
+# maximum number of alerts to look up with one query, each alert key uses three parameters and
+# older SQLite versions allow only 999 parameters per query
+QUERY_CHUNK_SIZE = 300
+
+
+def _chunks(values, size=QUERY_CHUNK_SIZE):
+    for offset in range(0, len(values), size):
+        yield values[offset:offset + size]
 
 
 class Database:
+    """
+    The connection is opened lazily on first use and then kept open for the lifetime of the
+    process (until `close()` is called), so the schema is initialized only once and
+    the statement cache of the connection can be reused for all queries.
+    """
 
     def __init__(self, path):
         self._database_path = path
         self._connection = None
+        self._lock = RLock()
 
-    def insert_alert(self, alert):
+    def insert_alerts(self, alerts):
         query = '''
             INSERT INTO `alert` (`alert_id`, `alert_type`, `provider`, `entry_date`, `expire_date`)
             VALUES (?, ?, ?, ?, ?)
             ON CONFLICT DO UPDATE SET `expire_date`=`excluded`.`expire_date`;'''
 
-        # convert expire_date to UTC
-        expire_date = alert.expire_date.astimezone(timezone.utc) if alert.expire_date else None
+        entry_date = datetime.now(timezone.utc)
+        parameters = []
+        for alert in alerts:
+            # convert expire_date to UTC
+            expire_date = alert.expire_date.astimezone(timezone.utc) if alert.expire_date else None
+            parameters.append((alert.identifier,
+                               alert.alert_type,
+                               alert.provider_name,
+                               entry_date,
+                               expire_date))
 
+        # insert all alerts within a single transaction
         with self._connect() as connection:
-            connection.execute(query, (alert.identifier,
-                                       alert.alert_type,
-                                       alert.provider_name,
-                                       datetime.now(timezone.utc),
-                                       expire_date))
+            connection.executemany(query, parameters)
 
-    def get_alert_expire_date(self, alert):
+    def get_processed_alerts(self, alerts):
+        """
+        Look up all given alerts with a single query (per chunk of `QUERY_CHUNK_SIZE` alerts)
+        and return a dict which maps the key (see `Alert.key`) of each alert already present
+        in the database to its expire date (which might be None)
+        """
         # check if the alert was already processed but treat alerts with an expiry date as
         # unprocessed: update for alerts by "LHP" (flood reporting) are sent with the
         # same identifier and the type but their start and end dates will be updated
-        query = '''SELECT `expire_date`
-                   FROM `alert`
-                   WHERE `alert_id`=? AND `alert_type`=? AND `provider`=?;'''
+        keys = list(dict.fromkeys(alert.key for alert in alerts))
+        processed_alerts = {}
         with self._connect() as connection:
             cursor = connection.cursor()
-            result = cursor.execute(
-                query, (alert.identifier, alert.alert_type, alert.provider_name))
-            if row := result.fetchone():
-                return row['expire_date']
-
-        return None
-
-    def alert_exists(self, alert):
-        query = '''SELECT 1
-                   FROM `alert`
-                   WHERE `alert_id`=? AND `alert_type`=? AND `provider`=?;
-                '''
+            for chunk in _chunks(keys):
+                placeholders = ', '.join(['(?, ?, ?)'] * len(chunk))
+                query = f'''SELECT `alert_id`, `alert_type`, `provider`, `expire_date`
+                            FROM `alert`
+                            WHERE (`alert_id`, `alert_type`, `provider`)
+                                  IN (VALUES {placeholders});'''  # noqa: S608
+                parameters = [value for key in chunk for value in key]
+                for row in cursor.execute(query, parameters):
+                    key = (row['alert_id'], row['alert_type'], row['provider'])
+                    processed_alerts[key] = row['expire_date']
+
+        return processed_alerts
+
+    def get_http_cache_entry(self, url):
+        query = '''SELECT `etag`, `last_modified`, `content_hash`
+                   FROM `http_cache`
+                   WHERE `url`=?;'''
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            result = cursor.execute(query, (url,))
+            return result.fetchone()
+
+    def update_http_cache_entries(self, entries):
+        """
+        Store the validators of HTTP responses, `entries` is a list of tuples of
+        url, ETag, Last-Modified and the hash of the content
+        """
+        query = '''
+            INSERT INTO `http_cache` (`url`, `etag`, `last_modified`, `content_hash`, `update_date`)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT DO UPDATE SET `etag`=`excluded`.`etag`,
+                                      `last_modified`=`excluded`.`last_modified`,
+                                      `content_hash`=`excluded`.`content_hash`,
+                                      `update_date`=`excluded`.`update_date`;'''
+
+        update_date = datetime.now(timezone.utc)
+        parameters = [(*entry, update_date) for entry in entries]
+        with self._connect() as connection:
+            connection.executemany(query, parameters)
+
+    def get_provider_state(self, provider):
+        query = '''SELECT `state`
+                   FROM `provider_state`
+                   WHERE `provider`=?;'''
         with self._connect() as connection:
             cursor = connection.cursor()
-            result = cursor.execute(
-                query, (alert.identifier, alert.alert_type, alert.provider_name))
-            if result.fetchone() is not None:
-                return True
+            row = cursor.execute(query, (provider,)).fetchone()
+            return row['state'] if row else None
 
-        return False
+    def update_provider_state(self, provider, state):
+        query = '''
+            INSERT INTO `provider_state` (`provider`, `state`, `update_date`)
+            VALUES (?, ?, ?)
+            ON CONFLICT DO UPDATE SET `state`=`excluded`.`state`,
+                                      `update_date`=`excluded`.`update_date`;'''
+        with self._connect() as connection:
+            connection.execute(query, (provider, state, datetime.now(timezone.utc)))
 
     def expire_alerts(self, provider, keep_alert_days=30):
-        query = f'''DELETE FROM `alert`
-                    WHERE `provider`= ?
-                      AND (`expire_date` < datetime("now")
-                            OR `entry_date` < datetime('now', "-{keep_alert_days} days"));'''  # noqa: S608
+        query = '''DELETE FROM `alert`
+                   WHERE `provider`= ?
+                     AND (`expire_date` < datetime('now')
+                           OR `entry_date` < datetime('now', ?));'''
         with self._connect() as connection:
             cursor = connection.cursor()
-            cursor.execute(query, (provider,))
+            cursor.execute(query, (provider, f'-{keep_alert_days} days'))
             return cursor.rowcount
 
+    def insert_outbox_alerts(self, alerts, alerter_names, attachment_filter=None):
+        """
+        Store the alerts including their attachments (only those for which `attachment_filter`
+        returns True, if given) in the outbox to be delivered by all of `alerter_names` and
+        return the outbox ID of each alert
+        """
+        alert_query = '''
+            INSERT INTO `outbox` (`alert_id`, `alert_type`, `provider`, `title`, `text`,
+                                  `expire_date`, `entry_date`)
+            VALUES (?, ?, ?, ?, ?, ?, ?);'''
+        attachment_query = '''
+            INSERT INTO `outbox_attachment` (`outbox_id`, `position`, `filename`, `content`,
+                                             `mimetype`)
+            VALUES (?, ?, ?, ?, ?);'''
+        delivery_query = '''
+            INSERT INTO `outbox_delivery` (`outbox_id`, `alerter`)
+            VALUES (?, ?);'''
+
+        entry_date = datetime.now(timezone.utc)
+        outbox_ids = []
+        # insert all alerts within a single transaction
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            for alert in alerts:
+                expire_date = alert.expire_date.astimezone(timezone.utc) \
+                    if alert.expire_date else None
+                cursor.execute(alert_query, (alert.identifier,
+                                             alert.alert_type,
+                                             alert.provider_name,
+                                             alert.title,
+                                             alert.text,
+                                             expire_date,
+                                             entry_date))
+                outbox_id = cursor.lastrowid
+                attachments = [attachment for attachment in alert.attachments
+                               if attachment_filter is None or attachment_filter(attachment)]
+                cursor.executemany(attachment_query, [
+                    (outbox_id, position, attachment.filename, attachment.content,
+                     attachment.mimetype)
+                    for position, attachment in enumerate(attachments)])
+                cursor.executemany(delivery_query,
+                                   [(outbox_id, alerter_name) for alerter_name in alerter_names])
+                outbox_ids.append(outbox_id)
+
+        return outbox_ids
+
+    def get_outbox_deliveries(self):
+        """ Return all deliveries, `due` is false for failed ones to be retried later """
+        query = '''SELECT `outbox_id`, `alerter`, `attempts`,
+                          (`next_attempt_date` IS NULL
+                           OR `next_attempt_date` <= datetime('now')) AS `due`
+                   FROM `outbox_delivery`
+                   ORDER BY `outbox_id`;'''
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            return cursor.execute(query).fetchall()
+
+    def get_outbox_alerts(self, outbox_ids):
+        """
+        Return the outbox rows of the given IDs and the attachments of each
+        as a dict mapping the outbox ID to a list of attachment rows
+        """
+        alert_rows = []
+        attachment_rows = {}
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            for chunk in _chunks(list(outbox_ids)):
+                placeholders = ', '.join(['?'] * len(chunk))
+                query = f'''SELECT `outbox_id`, `alert_id`, `alert_type`, `provider`, `title`,
+                                   `text`, `expire_date`
+                            FROM `outbox`
+                            WHERE `outbox_id` IN ({placeholders})
+                            ORDER BY `outbox_id`;'''  # noqa: S608
+                alert_rows.extend(cursor.execute(query, chunk))
+
+                query = f'''SELECT `outbox_id`, `filename`, `content`, `mimetype`
+                            FROM `outbox_attachment`
+                            WHERE `outbox_id` IN ({placeholders})
+                            ORDER BY `outbox_id`, `position`;'''  # noqa: S608
+                for row in cursor.execute(query, chunk):
+                    attachment_rows.setdefault(row['outbox_id'], []).append(row)
+
+        return alert_rows, attachment_rows
+
+    def increment_outbox_delivery_attempts(self, alerter_name, outbox_ids, retry_delay,
+                                           max_retry_delay):
+        """
+        Count a failed attempt and delay the next one by `retry_delay` seconds, doubled for each
+        previous attempt up to `max_retry_delay` seconds
+        """
+        query = '''UPDATE `outbox_delivery`
+                   SET `attempts`=`attempts` + 1,
+                       `next_attempt_date`=datetime(
+                           'now', '+' || min(? << `attempts`, ?) || ' seconds')
+                   WHERE `outbox_id`=? AND `alerter`=?;'''
+        parameters = [(retry_delay, max_retry_delay, outbox_id, alerter_name)
+                      for outbox_id in outbox_ids]
+        with self._connect() as connection:
+            connection.executemany(query, parameters)
+
+    def get_outbox_delivered_targets(self, alerter_name, outbox_id):
+        query = '''SELECT `target`
+                   FROM `outbox_delivered_target`
+                   WHERE `outbox_id`=? AND `alerter`=?;'''
+        with self._connect() as connection:
+            cursor = connection.cursor()
+            return {row['target'] for row in cursor.execute(query, (outbox_id, alerter_name))}
+
+    def insert_outbox_delivered_target(self, alerter_name, outbox_id, target):
+        query = '''INSERT OR IGNORE INTO `outbox_delivered_target`
+                       (`outbox_id`, `alerter`, `target`)
+                   VALUES (?, ?, ?);'''
+        with self._connect() as connection:
+            connection.execute(query, (outbox_id, alerter_name, target))
+
+    def delete_outbox_deliveries(self, alerter_name, outbox_ids):
+        """ Delete the deliveries and all alerts which need no other delivery from the outbox """
+        delivery_queries = (
+            '''DELETE FROM `outbox_delivery`
+               WHERE `outbox_id`=? AND `alerter`=?;''',
+            '''DELETE FROM `outbox_delivered_target`
+               WHERE `outbox_id`=? AND `alerter`=?;''',
+        )
+        cleanup_queries = (
+            '''DELETE FROM `outbox_attachment`
+               WHERE `outbox_id`=?
+                 AND NOT EXISTS (SELECT 1 FROM `outbox_delivery` WHERE `outbox_id`=?);''',
+            '''DELETE FROM `outbox`
+               WHERE `outbox_id`=?
+                 AND NOT EXISTS (SELECT 1 FROM `outbox_delivery` WHERE `outbox_id`=?);''',
+        )
+        with self._connect() as connection:
+            for query in delivery_queries:
+                connection.executemany(query,
+                                       [(outbox_id, alerter_name) for outbox_id in outbox_ids])
+            for query in cleanup_queries:
+                connection.executemany(query, [(outbox_id, outbox_id) for outbox_id in outbox_ids])
+
+    def close(self):
+        with self._lock:
+            self._close()
+
     @contextmanager
     def _connect(self):
-        self._open()
-        try:
+        # the connection is shared between threads, so serialize access to it
+        with self._lock:
+            if self._connection is None:
+                self._open()
             with self._connection as connection:
                 yield connection
-        finally:
-            self._close()
 
     def _open(self):
         self._connection = sqlite3.connect(
             self._database_path,
             timeout=30,
-            isolation_level='EXCLUSIVE')
+            isolation_level='IMMEDIATE',
+            check_same_thread=False)
         self._connection.row_factory = sqlite3.Row
         self._initialize_schema()
 
-    def _initialize_schema(self):
+    def _initialize_pragmas(self):
         cursor = self._connection.cursor()
+        # WAL mode allows readers (e.g. a second Ninette instance) while we are writing and
+        # requires fewer fsync calls per transaction
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        cursor.execute('PRAGMA synchronous=NORMAL;')
+
+    def _initialize_schema(self):
         try:
+            self._initialize_pragmas()
+            cursor = self._connection.cursor()
             for statement in DATABASE_SCHEMA_STATEMENTS:
                 cursor.execute(statement)
         except Exception:
@@ -0,0 +1,138 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import logging
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import monotonic
+
+
+class AlertBatch:
+    """ Alerts of one provider run, `callback` is called once all alerters have processed them """
+
+    def __init__(self, alerts, callback, alerter_count):
+        self.alerts = alerts
+        self._callback = callback
+        self._pending_alerter_count = alerter_count
+        self._lock = Lock()
+
+    def alerter_finished(self):
+        with self._lock:
+            self._pending_alerter_count -= 1
+            finished = self._pending_alerter_count == 0
+
+        if finished:
+            self._callback(self.alerts)
+
+
+class AlerterWorker:
+    """ Thread which passes the queued alert batches to one alerter """
+
+    def __init__(self, alerter, queue_size, delivery_callback):
+        self.alerter = alerter
+        self._delivery_callback = delivery_callback
+        self.alerter_name = alerter.name
+        self._queue = Queue(maxsize=queue_size)
+        self._thread = Thread(target=self._work, name=f'Alerter-{self.alerter_name}', daemon=True)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, batch, timeout=None):
+        try:
+            self._queue.put_nowait(batch)
+        except Full:
+            # block the caller until the alerter caught up, this is our backpressure
+            self._logger.warning('Queue of alerter "%s" is full, waiting for it to catch up',
+                                 self.alerter_name)
+            self._queue.put(batch, timeout=timeout)
+
+    def stop(self, timeout):
+        deadline = monotonic() + timeout
+        try:
+            # tell the thread to stop after the queued batches
+            self._queue.put(None, timeout=timeout)
+        except Full:
+            return False
+
+        self._thread.join(timeout=max(deadline - monotonic(), 0))
+        return not self._thread.is_alive()
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+
+            if batch.alerts:
+                self._process_alerts(batch.alerts)
+            try:
+                batch.alerter_finished()
+            except Exception as exc:
+                self._logger.error('Error while finishing alerts of alerter "%s": %s',
+                                   self.alerter_name, exc)
+
+    def _process_alerts(self, alerts):
+        try:
+            delivered_alerts = self.alerter.process(alerts)
+        except Exception as exc:
+            self._logger.error('Error while processing alerts with alerter "%s": %s',
+                               self.alerter_name, exc)
+            delivered_alerts = []
+
+        if delivered_alerts is None:
+            delivered_alerts = alerts
+        try:
+            self._delivery_callback(self.alerter, alerts, delivered_alerts)
+        except Exception as exc:
+            self._logger.error('Error while finishing alerts of alerter "%s": %s',
+                               self.alerter_name, exc)
+
+
+class AlertDispatcher:
+    """
+    Pass alerts to the alerters in the background, so slow alerters do not delay fetching.
+
+    Each alerter has its own worker thread and a queue of at most `queue_size` alert batches,
+    if a queue is full `dispatch()` blocks until the alerter caught up.
+    `delivery_callback(alerter, alerts, delivered_alerts)` is called after each alerter
+    processed alerts.
+    """
+
+    def __init__(self, alerters, queue_size, shutdown_timeout, delivery_callback):
+        self._workers = {alerter: AlerterWorker(alerter, queue_size, delivery_callback)
+                         for alerter in alerters}
+        self._shutdown_timeout = shutdown_timeout
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        for worker in self._workers.values():
+            worker.start()
+
+    def dispatch(self, alerts, callback, alerters=None):
+        """
+        Queue `alerts` for `alerters` (all if None) and call `callback(alerts)` once all
+        are finished
+        """
+        workers = list(self._workers.values()) if alerters is None \
+            else [self._workers[alerter] for alerter in alerters]
+        if not workers:
+            callback(alerts)
+            return
+
+        batch = AlertBatch(alerts, callback, len(workers))
+        for worker in workers:
+            worker.put(batch)
+
+    def shutdown(self):
+        """ Wait until all queued alerts have been processed, at most `shutdown_timeout` """
+        deadline = monotonic() + self._shutdown_timeout
+        for worker in self._workers.values():
+            timeout = max(deadline - monotonic(), 0)
+            if not worker.stop(timeout):
+                # the remaining alerts will be fetched and alerted again on the next start
+                self._logger.error('Alerter "%s" did not finish within %s seconds, '
+                                   'stopping without waiting for it',
+                                   worker.alerter_name, self._shutdown_timeout)
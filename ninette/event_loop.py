@@ -0,0 +1,61 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from threading import Thread
+
+
+class EventLoopThread:
+    """
+    Run an asyncio event loop in a background thread, so the synchronous NinetteRunner can
+    run coroutines in it and wait for their results like for any other future.
+
+    Blocking functions (like synchronous providers) are run in the default executor of
+    the loop which uses up to `max_workers` threads.
+    """
+
+    def __init__(self, max_workers):
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='Provider')
+        self._loop.set_default_executor(self._executor)
+        self._thread = Thread(target=self._run, name='EventLoop', daemon=True)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, coroutine):
+        """ Schedule `coroutine` in the event loop and return a `concurrent.futures.Future` """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def stop(self, timeout):
+        """ Cancel all remaining tasks (e.g. stuck providers) and stop the event loop """
+        try:
+            self.submit(self._cancel_tasks()).result(timeout=timeout)
+        except FuturesTimeoutError:
+            self._logger.warning('Tasks did not finish within %s seconds after cancellation',
+                                 timeout)
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=timeout)
+        if not self._thread.is_alive():
+            self._loop.close()
+        # do not wait for stuck threads
+        self._executor.shutdown(wait=False)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    @staticmethod
+    async def _cancel_tasks():
+        current_task = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,152 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ninette import jsonlib
+
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def create_http_session(config):
+    """
+    Create a HTTP session to be shared by all providers, the session keeps connections alive
+    and retries failed requests with an increasing delay
+    """
+    retry = Retry(
+        total=config.http_retries,
+        backoff_factor=config.http_retry_backoff,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=('GET',),
+        # return the last response once all retries are exhausted, it is checked by the caller
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=config.http_pool_size,
+        pool_maxsize=config.http_pool_size,
+        max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if config.http_useragent:
+        session.headers['user-agent'] = config.http_useragent
+    if not config.http_keep_alive:
+        session.headers['connection'] = 'close'
+    if config.http_proxy:
+        session.proxies = {'http': config.http_proxy, 'https': config.http_proxy}
+
+    return session
+
+
+class HttpResponse:
+    """ Response of `AsyncHttpSession`, providing the used subset of `requests.Response` """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= HTTPStatus.BAD_REQUEST:
+            errmsg = f'{self.status_code} Error for url: {self.url}'
+            raise requests.HTTPError(errmsg)
+
+
+class AsyncHttpSession:
+    """
+    HTTP session for async providers to be used from the event loop of NinetteRunner.
+
+    If aiohttp is installed, all requests share one connection pool and are performed
+    concurrently in the event loop. Otherwise the requests are performed with the given
+    (synchronous) requests session in a thread pool.
+    """
+
+    def __init__(self, config, http_session):
+        self._config = config
+        self._http_session = http_session
+        self._client_session = None
+        self._executor = None
+
+    async def get(self, url, headers=None):
+        if aiohttp is None:
+            return await self._get_via_executor(url, headers)
+
+        return await self._get_via_aiohttp(url, headers)
+
+    async def close(self):
+        if self._client_session is not None:
+            await self._client_session.close()
+            self._client_session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _get_via_executor(self, url, headers):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._config.http_pool_size,
+                                                thread_name_prefix=self.__class__.__name__)
+
+        loop = asyncio.get_running_loop()
+        request = partial(self._get_via_requests, url, headers)
+        return await loop.run_in_executor(self._executor, request)
+
+    def _get_via_requests(self, url, headers):
+        response = self._http_session.get(url, headers=headers, timeout=self._config.timeout)
+        # wrap the response, so the content is decoded with `jsonlib` like with aiohttp
+        return HttpResponse(response.url, response.status_code, response.headers,
+                            response.content)
+
+    async def _get_via_aiohttp(self, url, headers):
+        client_session = self._get_client_session()
+        # retry like the requests session does, see create_http_session()
+        for attempt in range(self._config.http_retries + 1):
+            last_attempt = attempt >= self._config.http_retries
+            try:
+                async with client_session.get(url, headers=headers,
+                                              proxy=self._config.http_proxy) as response:
+                    if last_attempt or response.status not in RETRY_STATUS_CODES:
+                        content = await response.read()
+                        return HttpResponse(str(response.url), response.status,
+                                            response.headers, content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+
+            await asyncio.sleep(self._config.http_retry_backoff * 2 ** attempt)
+
+        return None  # not reached, the last attempt either returns or raises
+
+    def _get_client_session(self):
+        # the session must be created within the event loop
+        if self._client_session is None:
+            connector = aiohttp.TCPConnector(limit=0,
+                                             limit_per_host=self._config.http_pool_size,
+                                             force_close=not self._config.http_keep_alive)
+            headers = {}
+            if self._config.http_useragent:
+                headers['user-agent'] = self._config.http_useragent
+            self._client_session = aiohttp.ClientSession(
+                connector=connector,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self._config.timeout))
+
+        return self._client_session
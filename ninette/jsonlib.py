@@ -0,0 +1,57 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+"""
+JSON backend which uses orjson or ujson if installed (see the "speedups" extra) and falls back to
+the json module of the standard library otherwise.
+
+`dumps()` produces the same output with all backends: UTF-8 encoded bytes, non-ASCII characters
+are not escaped and either compact or indented by two spaces.
+"""
+
+import json
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+elif ujson is not None:
+    BACKEND = 'ujson'
+else:
+    BACKEND = 'json'
+
+
+def loads(data):
+    """ Decode the JSON document `data` (bytes or str) """
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, *, sort_keys=False, indent=False):
+    """ Encode `obj` as UTF-8 encoded JSON, indented by two spaces if `indent` is set """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if ujson is not None:
+        return ujson.dumps(obj, sort_keys=sort_keys, indent=2 if indent else 0,
+                           ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    separators = None if indent else (',', ':')
+    return json.dumps(obj, sort_keys=sort_keys, indent=2 if indent else None,
+                      separators=separators, ensure_ascii=False).encode('utf-8')
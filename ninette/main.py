@@ -4,11 +4,27 @@
 
 import logging
 import os
-from time import sleep
+from concurrent.futures import FIRST_COMPLETED, wait
+from time import monotonic, sleep
 from traceback import format_exc
 
+from ninette.attachment_store import AttachmentStore
 from ninette.constants import APP_NAME_VERSION
 from ninette.database import Database
+from ninette.dispatcher import AlertDispatcher
+from ninette.event_loop import EventLoopThread
+from ninette.http_session import AsyncHttpSession, create_http_session
+from ninette.outbox import Outbox
+from ninette.provider.base import AsyncProviderBase
+from ninette.scheduler import Scheduler
+
+
+# when not running in foreground, providers due within this number of seconds are run as well
+ONE_SHOT_DUE_TOLERANCE = 10
+# threads of the event loop in addition to one per provider for short blocking calls
+EVENT_LOOP_EXTRA_WORKERS = 4
+# maximum time in seconds to wait for cancelled providers when stopping
+EVENT_LOOP_SHUTDOWN_TIMEOUT = 5
 
 
 class StopFetchLoopError(Exception):
@@ -20,6 +36,14 @@ class NinetteRunner:
     def __init__(self, config):
         self._config = config
         self._database = None
+        self._http_session = None
+        self._async_http_session = None
+        self._attachment_store = None
+        self._outbox = None
+        self._dispatcher = None
+        self._event_loop = None
+        self._provider_futures = {}
+        self._scheduler = None
         self._logger = logging.getLogger(self.__class__.__name__)
 
     def show_version(self):
@@ -29,7 +53,26 @@ class NinetteRunner:
         self._setup_http_proxy()
         self._setup_logging()
         self._setup_database()
+        self._setup_http_session()
+        self._setup_attachment_store()
+        self._setup_outbox()
+        self._setup_dispatcher()
+        self._setup_event_loop()
+        self._setup_scheduler()
         self._logger.debug('Starting %s', APP_NAME_VERSION)
+        try:
+            self._fetch_loop()
+        finally:
+            self._shutdown_event_loop()
+            self._shutdown_dispatcher()
+            self._close_providers()
+            self._close_http_session()
+            self._close_attachment_store()
+            self._close_database()
+
+        self._logger.debug('Stopping %s', APP_NAME_VERSION)
+
+    def _fetch_loop(self):
         while True:
             try:
                 self._fetch_alerts()
@@ -45,8 +88,6 @@ class NinetteRunner:
                 self._logger.error('Unexpected error occurred: %s%s', exc, traceback)
                 self._wait_for_next_refresh_interval()
 
-        self._logger.debug('Stopping %s', APP_NAME_VERSION)
-
     def _setup_http_proxy(self):
         """
         If a HTTP proxy is configured, set it also as environment variable so also the "staticmaps"
@@ -77,32 +118,215 @@ class NinetteRunner:
         self._database = Database(self._config.database_filename)
         for provider in self._config.providers:
             provider.set_database(self._database)
+            provider.load_state()
+
+    def _close_database(self):
+        if self._database is not None:
+            self._database.close()
+            self._database = None
+
+    def _setup_http_session(self):
+        self._http_session = create_http_session(self._config)
+        self._async_http_session = AsyncHttpSession(self._config, self._http_session)
+        for provider in self._config.providers:
+            provider.set_http_session(self._http_session)
+            if isinstance(provider, AsyncProviderBase):
+                provider.set_async_http_session(self._async_http_session)
+
+    def _close_http_session(self):
+        if self._http_session is not None:
+            self._http_session.close()
+            self._http_session = None
+
+    def _setup_attachment_store(self):
+        self._attachment_store = AttachmentStore(self._config.attachments_directory)
+        for alerter in self._config.alerters:
+            alerter.set_attachment_store(self._attachment_store)
+
+    def _close_attachment_store(self):
+        if self._attachment_store is not None:
+            self._attachment_store.close()
+            self._attachment_store = None
+
+    def _setup_outbox(self):
+        self._outbox = Outbox(self._config, self._database, self._config.alerters,
+                              self._config.alerter_max_attempts)
+        for alerter in self._config.alerters:
+            alerter.set_outbox(self._outbox)
+
+    def _setup_dispatcher(self):
+        self._dispatcher = AlertDispatcher(self._config.alerters,
+                                           self._config.alerter_queue_size,
+                                           self._config.alerter_shutdown_timeout,
+                                           self._outbox.finish_deliveries)
+        self._dispatcher.start()
+
+    def _shutdown_dispatcher(self):
+        if self._dispatcher is not None:
+            # let the alerters process all queued alerts before stopping
+            self._dispatcher.shutdown()
+            self._dispatcher = None
+
+    def _setup_event_loop(self):
+        # all providers are run from one event loop, synchronous providers in a thread each,
+        # so a stuck provider cannot block any other provider
+        max_workers = len(self._config.providers) + EVENT_LOOP_EXTRA_WORKERS
+        self._event_loop = EventLoopThread(max_workers)
+        self._event_loop.start()
+
+    def _shutdown_event_loop(self):
+        if self._event_loop is None:
+            return
+
+        # do not wait for stuck providers, their alerts will be fetched again on the next run
+        try:
+            self._event_loop.submit(self._async_http_session.close()).result(
+                timeout=EVENT_LOOP_SHUTDOWN_TIMEOUT)
+        except Exception as exc:
+            self._logger.error('Error while closing the HTTP session: %s', exc)
+        self._event_loop.stop(EVENT_LOOP_SHUTDOWN_TIMEOUT)
+        self._event_loop = None
+        self._async_http_session = None
+
+    def _setup_scheduler(self):
+        self._scheduler = Scheduler(self._config.fetch_jitter)
+        for provider in self._config.providers:
+            if not self._config.foreground:
+                # cron jobs do not start exactly on time, run also nearly due providers
+                provider.set_due_tolerance(ONE_SHOT_DUE_TOLERANCE)
+            self._scheduler.schedule(provider, provider.get_next_run_delay())
+
+    def _close_providers(self):
+        for provider in self._config.providers:
+            try:
+                provider.close()
+            except Exception as exc:
+                self._logger.error('Error while closing provider "%s": %s',
+                                   provider.__class__.__name__, exc)
 
     def _fetch_alerts(self):
         self._logger.info('Checking for new alerts')
+        self._retry_pending_deliveries()
+        self._start_due_providers()
+        self._process_provider_results()
 
-        for provider in self._config.providers:
-            alerts = self._run_provider(provider)
-            self._process_alerts(alerts)
+    def _start_due_providers(self):
+        # providers are scheduled again once they have finished, see _process_provider_results()
+        for provider in self._scheduler.pop_due_items():
+            future = self._event_loop.submit(self._run_provider(provider))
+            deadline = monotonic() + self._config.provider_timeout
+            self._provider_futures[provider] = (future, deadline)
+
+    def _process_provider_results(self):
+        """
+        Process the alerts of each provider as soon as it has finished. When running in
+        foreground, return once the next provider is due to start it while other providers
+        are still running.
+        """
+        while True:
+            self._cancel_timed_out_providers()
+            if not self._provider_futures:
+                return
+
+            futures = {future: provider
+                       for provider, (future, _) in self._provider_futures.items()}
+            done, _ = wait(futures, timeout=self._get_provider_results_timeout(),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = futures[future]
+                del self._provider_futures[provider]
+                try:
+                    self._process_provider_result(provider, future)
+                finally:
+                    self._finish_provider_run(provider)
 
-    def _run_provider(self, provider):
-        if provider.should_run():
-            alerts = provider.run()
-            return alerts
+            if not done and self._is_next_provider_due():
+                return
 
-        return None
+    def _get_provider_results_timeout(self):
+        # wait at most until the first running provider times out or the next provider is due
+        earliest_deadline = min(deadline for _, deadline in self._provider_futures.values())
+        timeout = earliest_deadline - monotonic()
+        if self._config.foreground:
+            next_delay = self._scheduler.get_next_delay()
+            if next_delay is not None:
+                timeout = min(timeout, next_delay)
+        return max(timeout, 0)
 
-    def _process_alerts(self, alerts):
-        if not alerts or not self._config.alerters:
+    def _is_next_provider_due(self):
+        return self._config.foreground and self._scheduler.get_next_delay() == 0
+
+    def _cancel_timed_out_providers(self):
+        now = monotonic()
+        for provider, (future, deadline) in list(self._provider_futures.items()):
+            if deadline > now:
+                continue
+
+            self._logger.error('Provider "%s" did not finish within %s seconds, cancelling it',
+                               provider.__class__.__name__, self._config.provider_timeout)
+            # blocking calls of the provider cannot be interrupted but its result is not
+            # waited for anymore, its alerts will be fetched again on the next run
+            future.cancel()
+            del self._provider_futures[provider]
+            self._scheduler.schedule(provider, provider.get_next_run_delay())
+
+    def _finish_provider_run(self, provider):
+        try:
+            provider.save_state()
+        except Exception as exc:
+            self._logger.error('Error while saving the state of provider "%s": %s',
+                               provider.__class__.__name__, exc)
+        self._scheduler.schedule(provider, provider.get_next_run_delay())
+
+    async def _run_provider(self, provider):
+        start_time = monotonic()
+        alerts = await provider.run_async()
+        duration = monotonic() - start_time
+        return alerts, duration
+
+    def _process_provider_result(self, provider, future):
+        provider_name = provider.__class__.__name__
+        try:
+            alerts, duration = future.result()
+        except Exception as exc:
+            self._logger.error('Error while running provider "%s": %s', provider_name, exc,
+                               exc_info=self._config.debug)
             return
 
-        for alerter in self._config.alerters:
-            alerter.process(alerts)
+        self._logger.info('Provider "%s" finished in %.2f seconds with %s new alerts',
+                          provider_name, duration, len(alerts or ()))
+        alerts = alerts or []
+        processed_alerts, http_cache_entries = provider.take_processed_alerts()
+        # store the alerts in the outbox before remembering them as processed, so they are
+        # delivered from the outbox if Ninette is terminated before the alerters processed them
+        self._outbox.store(alerts)
+        provider.commit_processed_alerts(processed_alerts, http_cache_entries)
+        self._dispatch_alerts(alerts)
+
+    def _retry_pending_deliveries(self):
+        for alerter, alerts in self._outbox.get_pending_deliveries():
+            self._logger.info('Retrying delivery of %s alerts with alerter "%s"',
+                              len(alerts), alerter.name)
+            self._dispatch_alerts(alerts, [alerter])
+
+    def _dispatch_alerts(self, alerts, alerters=None):
+        if not alerts:
+            return
+
+        # keep the staged attachment files until all alerters have processed the alerts
+        self._attachment_store.retain(alerts)
+        self._dispatcher.dispatch(alerts, self._attachment_store.release, alerters)
 
     def _wait_for_next_refresh_interval(self):
         if not self._config.foreground:
             # raise a dedicated exception to break the while(true) loop in self.process()
             raise StopFetchLoopError
 
-        self._logger.debug('Sleeping for %s seconds', self._config.fetch_interval)
-        sleep(self._config.fetch_interval)
+        # sleep until the next provider is due but at most the global fetch interval,
+        # e.g. to retry failed deliveries or to process the results of slow providers
+        delay = self._scheduler.get_next_delay()
+        if delay is None or delay > self._config.fetch_interval:
+            delay = self._config.fetch_interval
+
+        self._logger.debug('Sleeping for %.1f seconds', delay)
+        sleep(delay)
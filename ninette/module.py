@@ -13,6 +13,7 @@ class ModuleBase:
 
     def __init__(self, config):
         self._config = config
+        self.name = self.__class__.__name__  # set to the config section name by the config parser
         self._logger = logging.getLogger(self.__class__.__name__)
 
     @classmethod
@@ -66,7 +66,7 @@ class NinetteArgumentParser:
             dest='fetch_interval',
             metavar='NUM',
             type=int,
-            help='Check for new events every X seconds (only used when in foreground)')
+            help='Check for new events at least every X seconds (only used when in foreground)')
 
         self._argument_parser.add_argument(
             '-n',
@@ -0,0 +1,154 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import logging
+from datetime import datetime
+from threading import Lock
+
+from ninette.alert import Alert
+
+
+# seconds to wait before retrying a failed delivery, doubled for each further attempt
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+
+
+class Outbox:
+    """
+    Persistent queue of alerts to be delivered by the alerters.
+
+    New alerts are stored including their attachments in the database before they are marked as
+    processed, together with a delivery for each alerter. A delivery is removed once the alerter
+    processed the alert successfully, so alerts not yet delivered (e.g. because Ninette was
+    terminated or an alerter failed) are delivered again from the database without fetching
+    them again. Failed deliveries are retried with an increasing delay up to `max_attempts`
+    times.
+    """
+
+    def __init__(self, config, database, alerters, max_attempts):
+        self._config = config
+        self._database = database
+        self._alerters = {alerter.name: alerter for alerter in alerters}
+        self._max_attempts = max_attempts
+        self._in_flight_deliveries = set()
+        self._lock = Lock()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def store(self, alerts):
+        if self._config.dry_run or not alerts or not self._alerters:
+            return  # do *not* write to database in dry-run mode
+
+        outbox_ids = self._database.insert_outbox_alerts(alerts, list(self._alerters),
+                                                         self._is_attachment_consumed)
+        with self._lock:
+            for alert, outbox_id in zip(alerts, outbox_ids):
+                alert.outbox_id = outbox_id
+                for alerter_name in self._alerters:
+                    self._in_flight_deliveries.add((outbox_id, alerter_name))
+
+    def get_pending_deliveries(self):
+        """
+        Return a list of tuples of alerter and alerts for all deliveries which are
+        neither finished nor currently processed
+        """
+        if self._config.dry_run:
+            return []
+
+        pending_deliveries = {}
+        expired_deliveries = {}
+        with self._lock:
+            for row in self._database.get_outbox_deliveries():
+                outbox_id = row['outbox_id']
+                alerter_name = row['alerter']
+                if (outbox_id, alerter_name) in self._in_flight_deliveries:
+                    continue
+
+                if alerter_name not in self._alerters:
+                    self._logger.warning('Discarding outbox entry %s for unknown alerter "%s"',
+                                         outbox_id, alerter_name)
+                    expired_deliveries.setdefault(alerter_name, []).append(outbox_id)
+                elif row['attempts'] >= self._max_attempts:
+                    self._logger.error('Giving up to deliver outbox entry %s with alerter "%s" '
+                                       'after %s attempts', outbox_id, alerter_name,
+                                       row['attempts'])
+                    expired_deliveries.setdefault(alerter_name, []).append(outbox_id)
+                elif row['due']:
+                    pending_deliveries.setdefault(alerter_name, []).append(outbox_id)
+                    self._in_flight_deliveries.add((outbox_id, alerter_name))
+
+        for alerter_name, outbox_ids in expired_deliveries.items():
+            self._database.delete_outbox_deliveries(alerter_name, outbox_ids)
+
+        if not pending_deliveries:
+            return []
+
+        alerts = self._read_alerts({outbox_id for outbox_ids in pending_deliveries.values()
+                                    for outbox_id in outbox_ids})
+        return [(self._alerters[alerter_name],
+                 [alerts[outbox_id] for outbox_id in outbox_ids if outbox_id in alerts])
+                for alerter_name, outbox_ids in pending_deliveries.items()]
+
+    def finish_deliveries(self, alerter, alerts, delivered_alerts):
+        """ Remove the delivered alerts from the outbox and remember the failed ones to retry """
+        outbox_ids = [alert.outbox_id for alert in alerts if alert.outbox_id is not None]
+        if not outbox_ids:
+            return
+
+        delivered_outbox_ids = {alert.outbox_id for alert in delivered_alerts}
+        failed_outbox_ids = [outbox_id for outbox_id in outbox_ids
+                             if outbox_id not in delivered_outbox_ids]
+        try:
+            self._database.delete_outbox_deliveries(
+                alerter.name, [outbox_id for outbox_id in outbox_ids
+                               if outbox_id in delivered_outbox_ids])
+            if failed_outbox_ids:
+                self._logger.warning('Alerter "%s" failed to deliver %s alerts, retrying later',
+                                     alerter.name, len(failed_outbox_ids))
+                self._database.increment_outbox_delivery_attempts(
+                    alerter.name, failed_outbox_ids, RETRY_DELAY, MAX_RETRY_DELAY)
+        finally:
+            with self._lock:
+                for outbox_id in outbox_ids:
+                    self._in_flight_deliveries.discard((outbox_id, alerter.name))
+
+    def get_delivered_targets(self, alerter, alert):
+        """ Return the targets (e.g. mail recipients) `alerter` already delivered `alert` to """
+        if alert.outbox_id is None:
+            return set()
+        return self._database.get_outbox_delivered_targets(alerter.name, alert.outbox_id)
+
+    def add_delivered_target(self, alerter, alert, target):
+        """
+        Remember that `alerter` delivered `alert` to `target`, so a retry after a partial
+        failure skips it
+        """
+        if alert.outbox_id is None:
+            return
+        self._database.insert_outbox_delivered_target(alerter.name, alert.outbox_id, target)
+
+    def _is_attachment_consumed(self, attachment):
+        # attachments not used by any alerter are not needed for later deliveries
+        return any(alerter.consumes_attachment(attachment) for alerter in self._alerters.values())
+
+    def _read_alerts(self, outbox_ids):
+        alert_rows, attachment_rows = self._database.get_outbox_alerts(sorted(outbox_ids))
+        alerts = {}
+        for row in alert_rows:
+            expire_date = datetime.fromisoformat(row['expire_date']) if row['expire_date'] else None
+            alert = Alert(
+                provider_name=row['provider'],
+                identifier=row['alert_id'],
+                title=row['title'],
+                text=row['text'],
+                alert_type=row['alert_type'],
+                expire_date=expire_date,
+                attachments_directory=self._config.attachments_directory)
+            alert.outbox_id = row['outbox_id']
+            for attachment_row in attachment_rows.get(row['outbox_id'], ()):
+                alert.add_attachment(attachment_row['filename'],
+                                     attachment_row['content'],
+                                     attachment_row['mimetype'])
+            alerts[alert.outbox_id] = alert
+
+        return alerts
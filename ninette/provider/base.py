@@ -2,61 +2,249 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE file for details.
 
+import asyncio
+import hashlib
 from abc import abstractmethod
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from http import HTTPStatus
 
-import requests
-
+from ninette import jsonlib
 from ninette.alert import Alert
+from ninette.http_session import AsyncHttpSession, create_http_session
 from ninette.module import ModuleBase
 
 
+class FetchInterval:
+    """
+    Interval in seconds between two runs of a provider (or a part of it).
+    If `min_interval` and `max_interval` are set, the interval adapts to the activity:
+    it is shortened to `min_interval` on activity (e.g. new alerts) and doubled on each run
+    without activity up to `max_interval`.
+    """
+
+    def __init__(self, interval, min_interval=None, max_interval=None):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_runtime = None
+
+    @property
+    def adaptive(self):
+        return self.min_interval is not None and self.max_interval is not None
+
+    def start(self, now=None):
+        self.last_runtime = now or datetime.now(timezone.utc)
+
+    def update(self, activity):
+        """ Adapt the interval after a run and return whether it changed """
+        if not self.adaptive:
+            return False
+
+        previous_interval = self.interval
+        if activity:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(max(self.interval * 2, self.min_interval), self.max_interval)
+        return self.interval != previous_interval
+
+    def get_state(self):
+        last_runtime = self.last_runtime.isoformat() if self.last_runtime else None
+        return {'last_runtime': last_runtime, 'interval': self.interval}
+
+    def set_state(self, state):
+        if state['last_runtime']:
+            self.last_runtime = datetime.fromisoformat(state['last_runtime'])
+        # the fixed interval might have been changed in the config in the meantime
+        if self.adaptive:
+            self.interval = min(max(state['interval'], self.min_interval), self.max_interval)
+
+    def get_next_run_delay(self, now=None):
+        if not self.last_runtime:
+            return 0
+
+        now = now or datetime.now(timezone.utc)
+        next_execution_datetime = self.last_runtime + timedelta(seconds=self.interval)
+        return max((next_execution_datetime - now).total_seconds(), 0)
+
+
 class ProviderBase(ModuleBase):
 
+    # whether changed responses of conditional requests count as activity for the adaptive
+    # fetch interval, disable for responses changing on every request (e.g. due to timestamps)
+    CHANGED_RESPONSE_IS_ACTIVITY = True
+
     def __init__(self, config, class_path, fetch_interval):
         super().__init__(config)
         self._database = None
+        self._http_session = None
         self._class_path = class_path
-        self._fetch_interval = fetch_interval
-        self._last_runtime = None
+        self._fetch_interval = FetchInterval(fetch_interval)
+        self._due_tolerance = 0
+        self._processed_alerts = {}
+        self._http_cache_entries = {}
+        self._changed_urls = set()
 
     def set_database(self, database):
         self._database = database
 
+    def set_http_session(self, http_session):
+        self._http_session = http_session
+
+    def set_fetch_interval_bounds(self, min_interval, max_interval):
+        """ Enable the adaptive fetch interval if both bounds are set, see `FetchInterval` """
+        self._fetch_interval.min_interval = min_interval
+        self._fetch_interval.max_interval = max_interval
+
+    def set_due_tolerance(self, due_tolerance):
+        """
+        Consider the provider (and e.g. the locations of NinaProvider) as due already up to
+        `due_tolerance` seconds before its next run, e.g. for cron jobs not starting exactly on time
+        """
+        self._due_tolerance = due_tolerance
+
+    @staticmethod
+    def _read_fetch_interval_bounds(config_parser, section_name):
+        min_interval = config_parser.getint(section_name, 'fetch_interval_min', fallback=None)
+        max_interval = config_parser.getint(section_name, 'fetch_interval_max', fallback=None)
+        return min_interval, max_interval
+
+    def close(self):
+        """ Release resources held by the provider, called once Ninette stops """
+
+    def load_state(self):
+        """
+        Restore the state of the provider (e.g. the last runtime) as saved by `save_state()`,
+        so providers which are not yet due are not run even if Ninette was restarted
+        (e.g. when run by cron)
+        """
+        state = self._database.get_provider_state(self.name)
+        if not state:
+            return
+
+        try:
+            self._set_state(jsonlib.loads(state))
+        except (ValueError, KeyError, TypeError) as exc:
+            self._logger.warning('Ignoring invalid provider state: %s', exc)
+
+    def save_state(self):
+        if self._config.dry_run:
+            return  # do *not* write to database in dry-run mode
+
+        self._database.update_provider_state(self.name,
+                                             jsonlib.dumps(self._get_state()).decode('utf-8'))
+
+    def _get_state(self):
+        return {'fetch_interval': self._fetch_interval.get_state()}
+
+    def _set_state(self, state):
+        self._fetch_interval.set_state(state['fetch_interval'])
+
     def should_run(self):
-        if not self._last_runtime:
-            return True
+        return self.get_next_run_delay() <= 0
+
+    def get_next_run_delay(self):
+        """ Return the seconds until the provider should run the next time """
+        return self._apply_due_tolerance(self._fetch_interval.get_next_run_delay())
 
-        now = datetime.now(timezone.utc)
-        next_execution_datetime = self._last_runtime + timedelta(seconds=self._fetch_interval)
-        return now >= next_execution_datetime
+    def _apply_due_tolerance(self, delay):
+        return 0 if delay <= self._due_tolerance else delay
 
     def run(self):
-        self._last_runtime = datetime.now(timezone.utc)
+        self._start_run()
         try:
             alerts = self._process()
         except Exception as exc:
-            self._logger.error('Error while fetching new alerts: %s', exc,
-                               exc_info=self._config.debug)
-            return None
+            return self._fail_run(exc)
+
+        return self._finish_run(alerts)
 
+    async def run_async(self):
+        """
+        Run the provider from the event loop of NinetteRunner,
+        synchronous providers are run in a thread of the loop's executor
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.run)
+
+    def _start_run(self):
+        self._fetch_interval.start()
+        self._processed_alerts = {}
+        self._http_cache_entries = {}
+        self._changed_urls = set()
+
+    def _fail_run(self, exc):
+        self._logger.error('Error while fetching new alerts: %s', exc,
+                           exc_info=self._config.debug)
+        # the alerts are not passed to the alerters, so forget them to fetch them again
+        self._processed_alerts = {}
+        self._http_cache_entries = {}
+
+    def _finish_run(self, alerts):
         self._expire_alerts()
+        self._update_fetch_interval(alerts)
         return alerts
 
+    def _update_fetch_interval(self, alerts):
+        # new alerts or changed responses of conditional requests count as activity
+        activity = bool(alerts) \
+            or (self.CHANGED_RESPONSE_IS_ACTIVITY and bool(self._changed_urls))
+        if self._fetch_interval.update(activity):
+            self._logger.debug('Changed fetch interval to %s seconds',
+                               self._fetch_interval.interval)
+
     @abstractmethod
     def _process(self):
         raise NotImplementedError
 
-    def _alert_needs_to_be_processed(self, alert):
+    def _alert_needs_to_be_processed(self, alert, processed_alerts=None):
+        """
+        `processed_alerts` is the result of `_query_processed_alerts()` for a list of alerts
+        including `alert`, if not passed the database is queried for this alert only
+        """
         if alert and self._config.dry_run:
             self._logger.debug('Alert "%s" would need processing', alert)
             return True  # always process events in dry-run mode
 
         if alert:
-            return not self._database.alert_exists(alert)
+            if alert.key in self._processed_alerts:
+                return False  # already processed in this run, e.g. for another location
+            if processed_alerts is None:
+                processed_alerts = self._query_processed_alerts([alert])
+            return alert.key not in processed_alerts
 
         return False
 
+    def _query_processed_alerts(self, alerts):
+        alerts = [alert for alert in alerts if alert]
+        if not alerts:
+            return {}
+
+        return self._database.get_processed_alerts(alerts)
+
+    def take_processed_alerts(self):
+        """
+        Return all alerts marked as processed and the remembered HTTP responses during
+        the last run to be passed to `commit_processed_alerts()` later.
+        """
+        alerts = list(self._processed_alerts.values())
+        http_cache_entries = list(self._http_cache_entries.values())
+        self._processed_alerts = {}
+        self._http_cache_entries = {}
+        return alerts, http_cache_entries
+
+    def commit_processed_alerts(self, alerts, http_cache_entries):
+        """
+        Store the alerts and HTTP responses as returned by `take_processed_alerts()`
+        in the database.
+        This is called once the alerts have been stored in the outbox, so if storing fails,
+        the alerts will be fetched and alerted again on the next run.
+        """
+        if alerts:
+            self._database.insert_alerts(alerts)
+        if http_cache_entries:
+            self._database.update_http_cache_entries(http_cache_entries)
+
     def _expire_alerts(self):
         deleted_row_count = self._database.expire_alerts(self._class_path,
                                                          self._config.alerts_max_days)
@@ -69,7 +257,8 @@ class ProviderBase(ModuleBase):
             return  # do *not* write to database in dry-run mode
 
         if alert:
-            self._database.insert_alert(alert)
+            # remember the alert, it is written to the database in commit_processed_alerts()
+            self._processed_alerts[alert.key] = alert
             self._log_new_alert(alert)
 
     def _log_new_alert(self, alert):
@@ -82,14 +271,141 @@ class ProviderBase(ModuleBase):
             title=title,
             alert_type=alert_type,
             expire_date=expire_date,
-            text=text)
-
-    def _perform_http_request(self, url):
-        response = requests.get(
-            url,
-            headers={'user-agent': self._config.http_useragent},
-            proxies={'http': self._config.http_proxy, 'https': self._config.http_proxy},
-            timeout=self._config.timeout
-        )
+            text=text,
+            attachments_directory=self._config.attachments_directory)
+
+    def _perform_http_request(self, url, headers=None):
+        if self._http_session is None:
+            # the session is usually set by NinetteRunner, create our own if not
+            self._http_session = create_http_session(self._config)
+
+        response = self._http_session.get(url, headers=headers, timeout=self._config.timeout)
         response.raise_for_status()
         return response
+
+    def _perform_conditional_http_request(self, url):
+        """
+        Perform a HTTP request which returns None if the content did not change since
+        the response was remembered the last time with `_remember_http_response()`,
+        either because the server answered "304 Not Modified" or the content is the same.
+        The built-in providers are asynchronous and use
+        `_perform_conditional_http_request_async()`, this is kept on purpose for synchronous
+        providers implementing `_process()` like `_perform_http_request()`.
+        """
+        cache_entry, headers = self._get_conditional_request_headers(url)
+        response = self._perform_http_request(url, headers=headers)
+        return self._check_conditional_response(url, response, cache_entry)
+
+    def _get_conditional_request_headers(self, url):
+        headers = {}
+        cache_entry = None
+        if not self._config.dry_run:  # always fetch everything in dry-run mode
+            cache_entry = self._database.get_http_cache_entry(url)
+        if cache_entry:
+            if cache_entry['etag']:
+                headers['if-none-match'] = cache_entry['etag']
+            if cache_entry['last_modified']:
+                headers['if-modified-since'] = cache_entry['last_modified']
+
+        return cache_entry, headers
+
+    def _check_conditional_response(self, url, response, cache_entry):
+        if response.status_code == HTTPStatus.NOT_MODIFIED:
+            self._logger.debug('Skipping not modified "%s"', url)
+            return None
+        if cache_entry and cache_entry['content_hash'] == self._hash_http_content(response):
+            self._logger.debug('Skipping unchanged "%s"', url)
+            return None
+
+        if cache_entry:
+            self._changed_urls.add(url)
+        return response
+
+    def _remember_http_response(self, url, response):
+        """
+        Remember the response of a conditional request once it has been processed completely,
+        it is written to the database in `commit_processed_alerts()`
+        """
+        if self._config.dry_run:
+            return  # do *not* write to database in dry-run mode
+
+        self._http_cache_entries[url] = (url,
+                                         response.headers.get('etag'),
+                                         response.headers.get('last-modified'),
+                                         self._hash_http_content(response))
+
+    @staticmethod
+    def _hash_http_content(response):
+        return hashlib.sha256(response.content).hexdigest()
+
+
+class AsyncProviderBase(ProviderBase):
+    """
+    Base class for providers implementing `_process_async()` as coroutine which is run in
+    the event loop of NinetteRunner. The HTTP requests of all async providers share one
+    connection pool and can be performed concurrently without a thread per request.
+    The event loop is shared by all providers, so blocking calls like database queries or
+    formatting alert texts must be run with `_run_blocking()` in the executor of the loop.
+    """
+
+    def __init__(self, config, class_path, fetch_interval):
+        super().__init__(config, class_path, fetch_interval)
+        self._async_http_session = None
+
+    def set_async_http_session(self, async_http_session):
+        self._async_http_session = async_http_session
+
+    def run(self):
+        """ Run the provider in a new event loop, NinetteRunner uses `run_async()` instead """
+        return asyncio.run(self._run_with_own_http_session())
+
+    async def run_async(self):
+        self._start_run()
+        try:
+            alerts = await self._process_async()
+        except Exception as exc:
+            return self._fail_run(exc)
+
+        return await self._run_blocking(self._finish_run, alerts)
+
+    @staticmethod
+    async def _run_blocking(function, *args):
+        """ Run the blocking `function` in the executor to not block the shared event loop """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(function, *args))
+
+    async def _run_with_own_http_session(self):
+        if self._async_http_session is not None:
+            return await self.run_async()
+
+        if self._http_session is None:
+            self._http_session = create_http_session(self._config)
+        # the session is bound to the event loop, so use it only for this run
+        self._async_http_session = AsyncHttpSession(self._config, self._http_session)
+        try:
+            return await self.run_async()
+        finally:
+            await self._async_http_session.close()
+            self._async_http_session = None
+
+    def _process(self):
+        raise NotImplementedError  # implement _process_async() instead
+
+    @abstractmethod
+    async def _process_async(self):
+        raise NotImplementedError
+
+    async def _perform_http_request_async(self, url, headers=None):
+        if self._async_http_session is None:
+            errmsg = 'No HTTP session set, use run() to run the provider outside of Ninette'
+            raise RuntimeError(errmsg)
+
+        response = await self._async_http_session.get(url, headers=headers)
+        response.raise_for_status()
+        return response
+
+    async def _perform_conditional_http_request_async(self, url):
+        """ See `_perform_conditional_http_request()` """
+        cache_entry, headers = await self._run_blocking(self._get_conditional_request_headers, url)
+        response = await self._perform_http_request_async(url, headers=headers)
+        return self._check_conditional_response(url, response, cache_entry)
@@ -2,12 +2,12 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE file for details.
 
+import asyncio
 from datetime import datetime, timezone
-from io import BytesIO
+from pathlib import Path
 
-import staticmaps
-
-from ninette.provider.base import ProviderBase
+from ninette.provider.base import AsyncProviderBase, FetchInterval
+from ninette.staticmap import StaticmapRenderer, TileCacheSettings
 
 
 class SkipAlreadyProcessedAlertError(Exception):
@@ -22,7 +22,33 @@ class SkipPastAlertError(Exception):
     pass
 
 
-class NinaProvider(ProviderBase):
+class NinaDashboard:
+    """ Dashboard of a configured location as fetched in one run """
+
+    def __init__(self, location_title, url, fetch_interval):
+        self.location_title = location_title
+        self.url = url
+        self.fetch_interval = fetch_interval
+        self.response = None
+        # keys of all alerts on this dashboard which need to be processed
+        self.alert_keys = set()
+        # set to False if processing any of the messages failed, to try again on the next run
+        self.complete = True
+
+
+class NinaAlertTask:
+    """ Processing state of a new alert in one run """
+
+    def __init__(self, alert, location_title):
+        self.alert = alert
+        self.location_title = location_title
+        self.processed = False
+        # set to True to process the alert again on the next run
+        self.retry = False
+        self.staticmap_future = None
+
+
+class NinaProvider(AsyncProviderBase):
     """
     https://docs.oasis-open.org/emergency/cap/v1.2/CAP-v1.2.html
     """
@@ -63,13 +89,18 @@ Weitere Informationen:
 Mehr Informationen unter: {url}
 '''
 
-    def __init__(self, config, class_path, fetch_interval, base_url, enable_test_alerts, locations):
+    def __init__(self, config, class_path, fetch_interval, base_url,  # noqa: PLR0913, PLR0917
+                 enable_test_alerts, locations, max_workers, staticmap_renderer):
         super().__init__(config, class_path, fetch_interval)
         self._base_url = base_url
         self._enable_test_alerts = enable_test_alerts
         self._locations = locations
-        self._alerts = None
-        self._location_title = None
+        self._max_workers = max_workers
+        self._staticmap_renderer = staticmap_renderer
+        self._dashboards = []
+        # each location has its own fetch interval which adapts to the activity in this location
+        self._location_fetch_intervals = {
+            location_name: FetchInterval(fetch_interval) for location_name in locations}
 
     @classmethod
     def create_from_config(cls, config, config_parser, section_name):
@@ -77,51 +108,260 @@ Mehr Informationen unter: {url}
         fetch_interval = config_parser.getint(section_name, 'fetch_interval')
         base_url = config_parser.get(section_name, 'base_url')
         enable_test_alerts = config_parser.getboolean(section_name, 'enable_test_alerts')
+        max_workers = config_parser.getint(section_name, 'max_workers', fallback=4)
         locations = {}
         for name, value in config_parser.items(section_name):
             if name.startswith('ags_'):
                 locations[name[4:]] = value
 
-        instance = cls(config, class_path, fetch_interval, base_url, enable_test_alerts, locations)
+        staticmap_renderer = None
+        if config_parser.getboolean(section_name, 'staticmap_enable', fallback=True):
+            staticmap_renderer = cls._factor_staticmap_renderer(config, config_parser,
+                                                                section_name)
+
+        instance = cls(config, class_path, fetch_interval, base_url, enable_test_alerts,
+                       locations, max_workers, staticmap_renderer)
+        instance.set_fetch_interval_bounds(
+            *cls._read_fetch_interval_bounds(config_parser, section_name))
         return instance
 
-    def _process(self):
-        self._alerts = []
+    @classmethod
+    def _factor_staticmap_renderer(cls, config, config_parser, section_name):
+        cache_dir = config_parser.get(section_name, 'staticmap_cache_dir',
+                                      fallback='~/.cache/ninette/tiles')
+        # maximum size in megabytes
+        max_size = config_parser.getint(section_name, 'staticmap_cache_max_size', fallback=100)
+        # maximum age in days
+        max_age = config_parser.getint(section_name, 'staticmap_cache_max_age', fallback=30)
+        image_cache_dir = config_parser.get(section_name, 'staticmap_image_cache_dir',
+                                            fallback='~/.cache/ninette/images')
+        # maximum size in megabytes
+        image_cache_max_size = config_parser.getint(
+            section_name, 'staticmap_image_cache_max_size', fallback=50)
+        workers = config_parser.getint(section_name, 'staticmap_workers', fallback=2)
+        timeout = config_parser.getfloat(section_name, 'staticmap_timeout', fallback=60)
+
+        tile_cache_settings = TileCacheSettings(Path(cache_dir).expanduser(),
+                                                max_size * 1024 * 1024,
+                                                max_age * 86400,
+                                                config.http_useragent)
+        return StaticmapRenderer(cls.STATICMAP_WIDTH, cls.STATICMAP_HEIGHT, tile_cache_settings,
+                                 Path(image_cache_dir).expanduser(),
+                                 image_cache_max_size * 1024 * 1024,
+                                 workers, timeout)
+
+    def close(self):
+        if self._staticmap_renderer is not None:
+            self._staticmap_renderer.close()
+
+    def set_fetch_interval_bounds(self, min_interval, max_interval):
+        super().set_fetch_interval_bounds(min_interval, max_interval)
+        for fetch_interval in self._location_fetch_intervals.values():
+            fetch_interval.min_interval = min_interval
+            fetch_interval.max_interval = max_interval
+
+    def _get_state(self):
+        state = super()._get_state()
+        state['locations'] = {location_name: fetch_interval.get_state()
+                              for location_name, fetch_interval
+                              in self._location_fetch_intervals.items()}
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        for location_name, location_state in state.get('locations', {}).items():
+            if location_name in self._location_fetch_intervals:
+                self._location_fetch_intervals[location_name].set_state(location_state)
+
+    def get_next_run_delay(self):
+        # run as soon as any of the locations is due
+        return self._apply_due_tolerance(
+            min((fetch_interval.get_next_run_delay()
+                 for fetch_interval in self._location_fetch_intervals.values()),
+                default=self._fetch_interval.get_next_run_delay()))
+
+    def _update_fetch_interval(self, alerts):
+        alert_keys = {alert.key for alert in alerts}
+        for dashboard in self._dashboards:
+            activity = bool(dashboard.alert_keys & alert_keys) \
+                or (self.CHANGED_RESPONSE_IS_ACTIVITY and dashboard.url in self._changed_urls)
+            if dashboard.fetch_interval.update(activity):
+                self._logger.debug('Changed fetch interval for AGS "%s" to %s seconds',
+                                   dashboard.location_title, dashboard.fetch_interval.interval)
+
+    async def _process_async(self):
+        dashboards = self._dashboards = self._factor_due_dashboards()
+        # limit the number of concurrent requests
+        semaphore = asyncio.Semaphore(self._max_workers)
+
+        # fetch the dashboards of all locations concurrently but check the contained
+        # messages in order of the configured locations
+        messages_per_dashboard = await asyncio.gather(
+            *(self._fetch_nina_alerts(dashboard, semaphore) for dashboard in dashboards))
+        tasks = {}
+        for dashboard, messages in zip(dashboards, messages_per_dashboard):
+            # looking up the alerts in the database would block the loop
+            new_alerts = await self._run_blocking(self._process_nina_alerts, dashboard, messages)
+            for alert in new_alerts:
+                dashboard.alert_keys.add(alert.key)
+                if alert.key in tasks:
+                    self._logger.debug('Skipping alert "%s", already processed for AGS "%s"',
+                                       alert.identifier, tasks[alert.key].location_title)
+                else:
+                    tasks[alert.key] = NinaAlertTask(alert, dashboard.location_title)
+
+        # then fetch the details of all new alerts concurrently
+        tasks = list(tasks.values())
+        await asyncio.gather(*(self._process_alert_details(task, semaphore) for task in tasks))
+
+        processed_tasks = [task for task in tasks if task.processed]
+        await self._attach_staticmap_images(processed_tasks)
+        alerts = [task.alert for task in processed_tasks]
+        for alert in alerts:
+            self._mark_alert_as_processed(alert)
+
+        retry_alert_keys = {task.alert.key for task in tasks if task.retry}
+        self._remember_processed_dashboards(dashboards, retry_alert_keys)
+        return alerts
+
+    def _factor_due_dashboards(self):
+        # use the start time of this run, so all locations with the same interval are due together
+        now = self._fetch_interval.last_runtime
+        dashboards = []
         for location_name, location_ags in self._locations.items():
-            self._location_title = location_name.title()
-            self._logger.debug('Checking for new Nina alerts in AGS "%s"', self._location_title)
-            try:
-                self._process_nina_alerts(location_ags)
-            except Exception as exc:
-                self._logger.error('Error while processing alerts for AGS "%s": %s',
-                                   self._location_title, exc)
+            fetch_interval = self._location_fetch_intervals[location_name]
+            if self._apply_due_tolerance(fetch_interval.get_next_run_delay(now)) > 0:
+                continue
+
+            fetch_interval.start(now)
+            url = self.NINA_URL_DASHBOARD.format(api_url=self._base_url, ags=location_ags)
+            dashboards.append(NinaDashboard(location_name.title(), url, fetch_interval))
+
+        return dashboards
+
+    async def _fetch_nina_alerts(self, dashboard, semaphore):
+        self._logger.debug('Checking for new Nina alerts in AGS "%s"', dashboard.location_title)
+        try:
+            async with semaphore:
+                dashboard.response = await self._perform_conditional_http_request_async(
+                    dashboard.url)
+            if dashboard.response is None:
+                return []  # nothing changed since the last run
+
+            # decoding large dashboards would block the loop
+            return await self._run_blocking(dashboard.response.json)
+        except Exception as exc:
+            self._logger.error('Error while processing alerts for AGS "%s": %s',
+                               dashboard.location_title, exc)
+            dashboard.response = None
+            return []
+
+    def _process_nina_alerts(self, dashboard, messages):
+        alerts = self._process_nina_messages(dashboard, messages)
+        # look up all alerts of the dashboard at once
+        processed_alerts = self._query_processed_alerts(alerts)
+        new_alerts = []
+        for alert in alerts:
+            if self._alert_needs_to_be_processed(alert, processed_alerts):
+                new_alerts.append(alert)
+            else:
+                self._logger.debug('Skipping already processed alert "%s" for AGS "%s"',
+                                   alert.identifier, dashboard.location_title)
 
-        return self._alerts
+        return new_alerts
 
-    def _process_nina_alerts(self, location_ags):
-        messages = self._fetch_nina_alerts(location_ags)
+    def _process_nina_messages(self, dashboard, messages):
+        alerts = []
         for message in messages:
             try:
                 alert = self._process_nina_message(message)
-                if self._alert_needs_to_be_processed(alert):
-                    self._fetch_alert_details(alert)
-                    self._alerts.append(alert)
-                    self._mark_alert_as_processed(alert)
-                else:
-                    raise SkipAlreadyProcessedAlertError  # noqa: TRY301
-            except SkipFutureAlertError:
-                self._logger.debug('Skipping not yet effective alert "%s"', alert.identifier)
-            except SkipPastAlertError:
-                self._logger.debug('Skipping past alert "%s"', alert.identifier)
-            except SkipAlreadyProcessedAlertError:
-                self._logger.debug('Skipping already processed alert "%s"', alert.identifier)
             except Exception as exc:
-                self._logger.error('Error while processing alert "%s": %s', message['id'], exc)
+                self._logger.error('Error while processing alert "%s": %s', message.get('id'), exc)
+                dashboard.complete = False
+                continue
+
+            if alert is None:
+                self._logger.debug('Skipping test alert "%s"', message.get('id'))
+                continue
+
+            alerts.append(alert)
+
+        return alerts
+
+    async def _process_alert_details(self, task, semaphore):
+        alert = task.alert
+        try:
+            async with semaphore:
+                await self._fetch_alert_details(alert, task.location_title)
+        except SkipFutureAlertError:
+            self._logger.debug('Skipping not yet effective alert "%s"', alert.identifier)
+            task.retry = True
+        except SkipPastAlertError:
+            self._logger.debug('Skipping past alert "%s"', alert.identifier)
+        except SkipAlreadyProcessedAlertError:
+            self._logger.debug('Skipping already processed alert "%s"', alert.identifier)
+        except Exception as exc:
+            self._logger.error('Error while processing alert "%s": %s', alert.identifier, exc)
+            task.retry = True
+        else:
+            task.processed = True
+            async with semaphore:
+                task.staticmap_future = await self._submit_staticmap_image(alert)
+
+    async def _submit_staticmap_image(self, alert):
+        if self._staticmap_renderer is None:
+            return None
+
+        try:
+            geojson = await self._get_geojson_from_api(alert)
+            # the renderer reads the image cache or renders inline without worker processes
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._staticmap_renderer.submit, geojson)
+        except Exception as exc:
+            self._logger.error('Error while creating map image for alert "%s": %s',
+                               alert.identifier, exc)
+            return None
+
+    async def _attach_staticmap_images(self, tasks):
+        futures = [task.staticmap_future for task in tasks if task.staticmap_future is not None]
+        if not futures:
+            return
+
+        # wait for the map images but do not delay the alerts longer than the configured timeout
+        timeout = self._staticmap_renderer.timeout
+        await asyncio.wait([asyncio.wrap_future(future) for future in futures], timeout=timeout)
+        for task in tasks:
+            future = task.staticmap_future
+            if future is None:
+                continue
+
+            alert = task.alert
+            if not future.done():
+                future.cancel()
+                self._logger.warning('Map image for alert "%s" not ready within %s seconds, '
+                                     'sending the alert without it', alert.identifier, timeout)
+                continue
+
+            try:
+                staticmap_image = future.result()
+            except Exception as exc:
+                self._logger.error('Error while creating map image for alert "%s": %s',
+                                   alert.identifier, exc)
+                continue
 
-    def _fetch_nina_alerts(self, location_ags):
-        api_url = self.NINA_URL_DASHBOARD.format(api_url=self._base_url, ags=location_ags)
-        response = self._perform_http_request(api_url)
-        return response.json()
+            staticmap_image_filename = f'staticmap_image_{alert.identifier}.png'
+            alert.add_attachment(staticmap_image_filename, staticmap_image, 'image/png')
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._staticmap_renderer.prune_caches)
+
+    def _remember_processed_dashboards(self, dashboards, retry_alert_keys):
+        # skip unchanged dashboards on the next run unless some of their alerts
+        # need to be processed again
+        for dashboard in dashboards:
+            if dashboard.response is not None and dashboard.complete \
+                    and not dashboard.alert_keys & retry_alert_keys:
+                self._remember_http_response(dashboard.url, dashboard.response)
 
     def _process_nina_message(self, message):
         # ignore this alert unless processing test alerts is requested
@@ -146,8 +386,12 @@ Mehr Informationen unter: {url}
 
         return element
 
-    def _alert_needs_to_be_processed(self, alert):
-        alert_needs_to_be_processed = super()._alert_needs_to_be_processed(alert)
+    def _alert_needs_to_be_processed(self, alert, processed_alerts=None):
+        if alert and processed_alerts is None and not self._config.dry_run:
+            processed_alerts = self._query_processed_alerts([alert])
+
+        alert_needs_to_be_processed = super()._alert_needs_to_be_processed(alert,
+                                                                           processed_alerts)
 
         # NINA / Mowas specific handling of expiry date on recurring event IDs (e.g. for LHP)
         if alert:
@@ -157,8 +401,8 @@ Mehr Informationen unter: {url}
             if alert_needs_to_be_processed:
                 return True  # process alerts which are not present in the database
 
-            # if we got an alert, query its expire date, convert to datetime and set on alert
-            expire_date = self._database.get_alert_expire_date(alert)
+            # if we got an alert, get its expire date, convert to datetime and set on alert
+            expire_date = processed_alerts.get(alert.key)
             if expire_date:
                 alert.expire_date = datetime.strptime(expire_date, '%Y-%m-%d %H:%M:%S%z')
             # re-process existing alerts with an expire date set
@@ -167,11 +411,16 @@ Mehr Informationen unter: {url}
 
         return False
 
-    def _fetch_alert_details(self, alert):  # noqa: PLR0915
+    async def _fetch_alert_details(self, alert, location_title):
         # fetch alert details
         api_url = self.NINA_URL_ALERT_DETAILS.format(api_url=self._base_url,
                                                      identifier=alert.identifier)
-        response = self._perform_http_request(api_url)
+        response = await self._perform_http_request_async(api_url)
+        # parsing and formatting the details would block the loop
+        await self._run_blocking(self._process_alert_details_response, alert, response,
+                                 location_title)
+
+    def _process_alert_details_response(self, alert, response, location_title):
         detail_message = response.json()
 
         # find the info block with the best matching language
@@ -235,12 +484,12 @@ Mehr Informationen unter: {url}
         instruction = self._factor_instruction_text(instruction, instruction_text)
 
         alert.expire_date = expires
-        alert.title = f'NINA: {title} ({self._location_title})'
+        alert.title = f'NINA: {title} ({location_title})'
         alert.text = self.ALERT_TEXT.format(
             title=alert.title,
             categories=categories,
             identifier=alert.identifier,
-            county=self._location_title,
+            county=location_title,
             date=date,
             areas=areas,
             event=event,
@@ -254,11 +503,7 @@ Mehr Informationen unter: {url}
             url=url,
             text=text,
         )
-        # generate and attach a staticmap of the alert
-        staticmap_image = self._create_staticmap_image(alert)
-        staticmap_image_filename = f'staticmap_image_{alert.identifier}.png'
-        alert.add_attachment(staticmap_image_filename, staticmap_image, 'image/png')
-        # attach the original json to the alert
+        # attach the original json to the alert, the staticmap image is attached later
         alert.attach_original_event(detail_message)
 
     @staticmethod
@@ -301,46 +546,8 @@ Mehr Informationen unter: {url}
 
         return instruction
 
-    def _create_staticmap_image(self, alert):
-        response_geojson = self._get_geojson_from_api(alert)
-
-        tile_downloader = staticmaps.TileDownloader()
-        tile_downloader.set_user_agent(self._config.http_useragent)
-
-        context = staticmaps.Context()
-        context.set_tile_downloader(tile_downloader)
-        context.set_tile_provider(staticmaps.tile_provider_OSM)
-
-        self._add_polygons_to_content(response_geojson, context)
-
-        image_buffer = BytesIO()
-        image = context.render_pillow(self.STATICMAP_WIDTH, self.STATICMAP_HEIGHT)
-        image.save(image_buffer, 'png')
-
-        image_buffer.seek(0)
-        image_bytes = image_buffer.getvalue()
-        image_buffer.close()
-        return image_bytes
-
-    def _get_geojson_from_api(self, alert):
+    async def _get_geojson_from_api(self, alert):
         api_url = self.NINA_URL_ALERT_GEOJSON.format(api_url=self._base_url,
                                                      identifier=alert.identifier)
-        response = self._perform_http_request(api_url)
-        return response.json()
-
-    @staticmethod
-    def _add_polygons_to_content(geojson, context):
-        polygons = []
-        for feature in geojson['features']:
-            for coordinates in feature['geometry']['coordinates']:
-                if feature['geometry']['type'] == 'MultiPolygon':
-                    polygons.extend(coordinates)
-                else:
-                    polygons.append(coordinates)
-
-        for polygon in polygons:
-            latlngs = [staticmaps.create_latlng(lat, lng) for lng, lat in polygon]
-            area = staticmaps.Area(latlngs, width=2,
-                                   fill_color=staticmaps.parse_color('#00FF002F'),
-                                   color=staticmaps.parse_color('#8888FF'))
-            context.add_object(area)
+        response = await self._perform_http_request_async(api_url)
+        return await self._run_blocking(response.json)
@@ -13,7 +13,10 @@ class PingProvider(ProviderBase):
     def create_from_config(cls, config, config_parser, section_name):
         class_path = config_parser.get(section_name, 'class_path')
         fetch_interval = config_parser.getint(section_name, 'fetch_interval', fallback=1800)
-        return cls(config, class_path, fetch_interval)
+        instance = cls(config, class_path, fetch_interval)
+        instance.set_fetch_interval_bounds(
+            *cls._read_fetch_interval_bounds(config_parser, section_name))
+        return instance
 
     def _process(self):
         self._logger.info('Checking for new Ping alerts')
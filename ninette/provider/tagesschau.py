@@ -2,7 +2,7 @@
 # This software may be modified and distributed under the terms
 # of the MIT license.  See the LICENSE file for details.
 
-from ninette.provider.base import ProviderBase
+from ninette.provider.base import AsyncProviderBase
 
 
 ALERT_TEXT = '''Eilmeldung: {title}
@@ -18,7 +18,10 @@ Mehr Informationen unter: {url}
 '''
 
 
-class TagesschauBreakingNewsProvider(ProviderBase):
+class TagesschauBreakingNewsProvider(AsyncProviderBase):
+
+    # the homepage changes on almost every request, only new breaking news count as activity
+    CHANGED_RESPONSE_IS_ACTIVITY = False
 
     def __init__(self, config, class_path, fetch_interval, api_url):
         super().__init__(config, class_path, fetch_interval)
@@ -30,29 +33,38 @@ class TagesschauBreakingNewsProvider(ProviderBase):
         fetch_interval = config_parser.getint(section_name, 'fetch_interval')
         api_url = config_parser.get(section_name, 'api_url')
         instance = cls(config, class_path, fetch_interval, api_url)
+        instance.set_fetch_interval_bounds(
+            *cls._read_fetch_interval_bounds(config_parser, section_name))
         return instance
 
-    def _process(self):
+    async def _process_async(self):
         self._logger.info('Checking for Tagesschau breaking news')
-        alerts = self._process_tagesschau_breaking_news()
+        alerts = await self._process_tagesschau_breaking_news()
         return alerts
 
-    def _process_tagesschau_breaking_news(self):
-        news = self._fetch_tagesschau_news_feed()
+    async def _process_tagesschau_breaking_news(self):
+        response = await self._perform_conditional_http_request_async(self._api_url)
+        if response is None:
+            return None  # nothing changed since the last run
+
+        # decoding the news, converting the HTML and looking up the alerts in the database
+        # would block the loop
+        return await self._run_blocking(self._process_breaking_news, response)
+
+    def _process_breaking_news(self, response):
+        news = response.json()
         alerts = self._process_tagesschau_news(news)
+        processed_alerts = self._query_processed_alerts(alerts)
         for alert in list(alerts):
-            if self._alert_needs_to_be_processed(alert):
+            if self._alert_needs_to_be_processed(alert, processed_alerts):
                 self._mark_alert_as_processed(alert)
             else:
                 self._logger.debug('Skipping already processed alert "%s"', alert.identifier)
                 alerts.remove(alert)
 
+        self._remember_http_response(self._api_url, response)
         return alerts or None
 
-    def _fetch_tagesschau_news_feed(self):
-        response = self._perform_http_request(self._api_url)
-        return response.json()
-
     def _process_tagesschau_news(self, news):
         alerts_news = self._process_news_list(news.get('news', []))
         alerts_regional = self._process_news_list(news.get('regional', []))
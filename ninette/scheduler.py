@@ -0,0 +1,44 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import heapq
+import random
+from itertools import count
+from time import monotonic
+
+
+class Scheduler:
+    """
+    Keep track of the next due time of items (e.g. providers) in a heap, so the next due item
+    is known without checking all items.
+
+    A random delay of up to `jitter` seconds is added to each delayed item, so items with
+    the same interval do not always become due at the same time.
+    """
+
+    def __init__(self, jitter=0):
+        self._jitter = jitter
+        self._heap = []
+        self._counter = count()  # keep the order of items with the same due time
+
+    def schedule(self, item, delay):
+        if delay > 0 and self._jitter:
+            delay += random.uniform(0, self._jitter)  # noqa: S311
+        heapq.heappush(self._heap, (monotonic() + delay, next(self._counter), item))
+
+    def pop_due_items(self):
+        now = monotonic()
+        items = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, item = heapq.heappop(self._heap)
+            items.append(item)
+
+        return items
+
+    def get_next_delay(self):
+        """ Return the seconds until the next item is due or None if no item is scheduled """
+        if not self._heap:
+            return None
+
+        return max(self._heap[0][0] - monotonic(), 0)
@@ -0,0 +1,392 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import time
+
+import requests
+import staticmaps
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# maximum deviation in pixels of simplified polygons from the original polygons
+SIMPLIFY_TOLERANCE_PIXELS = 0.5
+MIN_POLYGON_POINTS = 3
+# tile downloaders of the current process, see _get_tile_downloader()
+_tile_downloaders = {}
+
+
+class TileCacheSettings:
+
+    def __init__(self, cache_dir, max_size, max_age, user_agent):
+        self.cache_dir = str(cache_dir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.user_agent = user_agent
+
+    def key(self):
+        return (self.cache_dir, self.max_size, self.max_age, self.user_agent)
+
+
+class CachingTileDownloader(staticmaps.TileDownloader):
+    """
+    Tile downloader with a size bounded cache on disk, to be shared by all maps rendered in
+    a process.
+    Cached tiles older than `max_age` seconds are downloaded again, if the cache grows beyond
+    `max_size` bytes the least recently used tiles are removed by `prune_cache()`.
+    """
+
+    TILE_DOWNLOAD_TIMEOUT = 10
+
+    def __init__(self, cache_dir, max_size, max_age):
+        super().__init__()
+        self.cache_dir = str(cache_dir)
+        self._max_size = max_size
+        self._max_age = max_age
+        self._http_session = requests.Session()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def get(self, provider, cache_dir, zoom, x, y):
+        file_name = Path(self.cache_file_name(provider, cache_dir, zoom, x, y))
+        data = read_cache_file(file_name, self._max_age)
+        if data is not None:
+            return data
+
+        url = provider.url(zoom, x, y)
+        if url is None:
+            return None
+
+        data = self._download_tile(url)
+        write_cache_file(file_name, data)
+        return data
+
+    def _download_tile(self, url):
+        response = self._http_session.get(url, headers={'user-agent': self._user_agent},
+                                          timeout=self.TILE_DOWNLOAD_TIMEOUT)
+        if response.status_code != requests.codes.ok:
+            errmsg = f'fetch {url} yields {response.status_code}'
+            raise RuntimeError(errmsg)
+
+        return response.content
+
+    def prune_cache(self):
+        removed_tiles = prune_cache_directory(self.cache_dir, self._max_size)
+        if removed_tiles:
+            self._logger.debug('Removed %s tiles from the cache in "%s"',
+                               removed_tiles, self.cache_dir)
+
+
+class StaticmapRenderer:
+    """
+    Render map images of the areas of GeoJSON features, either in a pool of `workers`
+    processes or, if `workers` is 0, in the calling thread.
+    Rendered images are cached in `image_cache_dir` by the hash of the geometries, so
+    alerts for the same area reuse the image without downloading tiles or rendering.
+    """
+
+    def __init__(self, width, height, tile_cache_settings,
+                 image_cache_dir, image_cache_max_size, workers, timeout):
+        self.timeout = timeout
+        self._width = width
+        self._height = height
+        self._tile_cache_settings = tile_cache_settings
+        self._image_cache_dir = Path(image_cache_dir)
+        self._image_cache_max_size = image_cache_max_size
+        self._workers = workers
+        self._executor = None
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def submit(self, geojson):
+        image_file_name = self._factor_image_cache_file_name(geojson)
+        image_bytes = read_cache_file(image_file_name, self._tile_cache_settings.max_age)
+        if image_bytes is not None:
+            self._logger.debug('Using cached map image "%s"', image_file_name.name)
+            return self._factor_finished_future(lambda: image_bytes)
+
+        if self._workers <= 0:
+            return self._factor_finished_future(lambda: self._render(geojson, image_file_name))
+
+        if self._executor is None:
+            # do not fork the (multi-threaded) main process, start fresh worker processes
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+        future = self._executor.submit(
+            render_staticmap, geojson, self._width, self._height, self._tile_cache_settings)
+        future.add_done_callback(partial(self._write_image_to_cache, image_file_name))
+        return future
+
+    @staticmethod
+    def _factor_finished_future(function):
+        future = Future()
+        try:
+            future.set_result(function())
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def _render(self, geojson, image_file_name):
+        image_bytes = render_staticmap(geojson, self._width, self._height,
+                                       self._tile_cache_settings)
+        write_cache_file(image_file_name, image_bytes)
+        return image_bytes
+
+    def _write_image_to_cache(self, image_file_name, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        try:
+            write_cache_file(image_file_name, future.result())
+        except OSError as exc:
+            self._logger.warning('Unable to cache map image "%s": %s', image_file_name, exc)
+
+    def _factor_image_cache_file_name(self, geojson):
+        geometries = [feature['geometry'] for feature in geojson['features']]
+        geometries_json = json.dumps(geometries, sort_keys=True, separators=(',', ':'))
+        content_hash = hashlib.sha256(geometries_json.encode())
+        content_hash.update(f'{self._width}x{self._height}'.encode())
+        return self._image_cache_dir / f'{content_hash.hexdigest()}.png'
+
+    def prune_caches(self):
+        _get_tile_downloader(self._tile_cache_settings).prune_cache()
+        removed_images = prune_cache_directory(self._image_cache_dir, self._image_cache_max_size)
+        if removed_images:
+            self._logger.debug('Removed %s map images from the cache in "%s"',
+                               removed_images, self._image_cache_dir)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def render_staticmap(geojson, width, height, tile_cache_settings):
+    context = staticmaps.Context()
+    tile_downloader = _get_tile_downloader(tile_cache_settings)
+    context.set_tile_downloader(tile_downloader)
+    context.set_cache_dir(tile_downloader.cache_dir)
+    context.set_tile_provider(staticmaps.tile_provider_OSM)
+
+    _add_polygons_to_context(geojson, context, width, height)
+
+    image_buffer = BytesIO()
+    image = context.render_pillow(width, height)
+    image.save(image_buffer, 'png')
+
+    image_buffer.seek(0)
+    image_bytes = image_buffer.getvalue()
+    image_buffer.close()
+    return image_bytes
+
+
+def read_cache_file(file_name, max_age):
+    """ Return the content of the cache file or None if it does not exist or is too old """
+    now = time()
+    # the file might be removed concurrently at any time, e.g. by the cache cleanup
+    try:
+        stat_result = file_name.stat()
+        if now - stat_result.st_mtime >= max_age:
+            return None
+
+        data = file_name.read_bytes()
+        # the access time is used to find the least recently used files, update it
+        # explicitly as file systems are often mounted with "noatime" or "relatime"
+        os.utime(file_name, (now, stat_result.st_mtime))
+    except FileNotFoundError:
+        return None
+
+    return data
+
+
+def write_cache_file(file_name, data):
+    file_name.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first to not expose incomplete files to concurrent readers
+    with NamedTemporaryFile(dir=file_name.parent, delete=False) as temp_file:
+        temp_file.write(data)
+    Path(temp_file.name).replace(file_name)
+
+
+def prune_cache_directory(directory, max_size):
+    """
+    Remove the least recently used files in `directory` until their total size is below
+    `max_size` and return the number of removed files
+    """
+    cache_files = []
+    cache_size = 0
+    for file_name in Path(directory).rglob('*.png'):
+        try:
+            stat_result = file_name.stat()
+        except FileNotFoundError:
+            continue
+        cache_files.append((stat_result.st_atime, stat_result.st_size, file_name))
+        cache_size += stat_result.st_size
+
+    removed_files = 0
+    if cache_size <= max_size:
+        return removed_files
+
+    for _, size, file_name in sorted(cache_files):
+        file_name.unlink(missing_ok=True)
+        cache_size -= size
+        removed_files += 1
+        if cache_size <= max_size:
+            break
+
+    return removed_files
+
+
+def _get_tile_downloader(tile_cache_settings):
+    # reuse the tile downloader for all maps rendered in this process
+    key = tile_cache_settings.key()
+    tile_downloader = _tile_downloaders.get(key)
+    if tile_downloader is None:
+        tile_downloader = CachingTileDownloader(tile_cache_settings.cache_dir,
+                                                tile_cache_settings.max_size,
+                                                tile_cache_settings.max_age)
+        if tile_cache_settings.user_agent:
+            tile_downloader.set_user_agent(tile_cache_settings.user_agent)
+        _tile_downloaders[key] = tile_downloader
+
+    return tile_downloader
+
+
+def _add_polygons_to_context(geojson, context, width, height):
+    polygons = []
+    for feature in geojson['features']:
+        for coordinates in feature['geometry']['coordinates']:
+            if feature['geometry']['type'] == 'MultiPolygon':
+                polygons.extend(coordinates)
+            else:
+                polygons.append(coordinates)
+
+    for polygon in simplify_polygons(polygons, width, height):
+        latlngs = [staticmaps.create_latlng(lat, lng) for lng, lat in polygon]
+        area = staticmaps.Area(latlngs, width=2,
+                               fill_color=staticmaps.parse_color('#00FF002F'),
+                               color=staticmaps.parse_color('#8888FF'))
+        context.add_object(area)
+
+
+def simplify_polygons(polygons, width, height):
+    """
+    Simplify the polygons (lists of longitude/latitude pairs) with the Douglas-Peucker algorithm
+    using a tolerance of a fraction of a pixel of a map of the given size showing all polygons,
+    so the simplified polygons look the same on the map. Identical polygons are returned once,
+    polygons collapsing to less than 3 distinct points (i.e. smaller than a pixel) are dropped.
+    """
+    points = [point for polygon in polygons for point in polygon]
+    if not points:
+        return polygons
+
+    min_lng = min(lng for lng, _ in points)
+    max_lng = max(lng for lng, _ in points)
+    min_lat = min(lat for _, lat in points)
+    max_lat = max(lat for _, lat in points)
+    # project to an equirectangular plane with the same aspect ratio as the Mercator map
+    # around the center of the polygons
+    lng_scale = math.cos(math.radians((min_lat + max_lat) / 2))
+    # the map is zoomed to show all polygons, so a pixel is at least that large
+    pixel_size = max((max_lng - min_lng) * lng_scale / width, (max_lat - min_lat) / height)
+    tolerance = pixel_size * SIMPLIFY_TOLERANCE_PIXELS
+    if tolerance <= 0:
+        return polygons
+
+    simplified_polygons = {}
+    for polygon in polygons:
+        projected_points = [(lng * lng_scale, lat) for lng, lat in polygon]
+        indices = _douglas_peucker(projected_points, tolerance)
+        simplified_polygon = tuple(tuple(polygon[index]) for index in indices)
+        if len(set(simplified_polygon)) < MIN_POLYGON_POINTS:
+            continue  # not visible anyway and staticmaps.Area needs at least 3 points
+        simplified_polygons.setdefault(simplified_polygon, None)
+
+    return list(simplified_polygons)
+
+
+def _douglas_peucker(points, tolerance):
+    """ Return the indices of the points to keep """
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+
+    if np is not None:
+        points = np.asarray(points, dtype=float)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    # iterate instead of recursion to not hit the recursion limit for large polygons
+    stack = [(0, count - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        index, distance = _find_farthest_point(points, start, end)
+        if distance > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [index for index, keep_point in enumerate(keep) if keep_point]
+
+
+def _find_farthest_point_numpy(points, start, end):
+    """ Return index and distance of the point between start and end farthest from their line """
+    start_x, start_y = points[start]
+    delta_x, delta_y = points[end] - points[start]
+    candidates = points[start + 1:end]
+    length = math.hypot(delta_x, delta_y)
+    if length == 0:
+        # closed rings start and end at the same point
+        distances = np.hypot(candidates[:, 0] - start_x, candidates[:, 1] - start_y)
+    else:
+        distances = np.abs(delta_y * (candidates[:, 0] - start_x)
+                              - delta_x * (candidates[:, 1] - start_y)) / length
+
+    index = int(np.argmax(distances))
+    return start + 1 + index, float(distances[index])
+
+
+def _find_farthest_point_python(points, start, end):
+    """ Return index and distance of the point between start and end farthest from their line """
+    start_x, start_y = points[start]
+    end_x, end_y = points[end]
+    delta_x = end_x - start_x
+    delta_y = end_y - start_y
+    length = math.hypot(delta_x, delta_y)
+
+    farthest_index = start + 1
+    farthest_distance = -1
+    for index in range(start + 1, end):
+        x, y = points[index]
+        if length == 0:
+            # closed rings start and end at the same point
+            distance = math.hypot(x - start_x, y - start_y)
+        else:
+            distance = abs(delta_y * (x - start_x) - delta_x * (y - start_y)) / length
+        if distance > farthest_distance:
+            farthest_index = index
+            farthest_distance = distance
+
+    return farthest_index, farthest_distance
+
+
+_find_farthest_point = _find_farthest_point_numpy if np is not None \
+    else _find_farthest_point_python
@@ -0,0 +1,44 @@
+#
+# This software may be modified and distributed under the terms
+# of the MIT license.  See the LICENSE file for details.
+
+from pathlib import Path
+
+import staticmaps
+
+from ninette.staticmap import _add_polygons_to_context, read_cache_file, simplify_polygons
+
+
+BIG_RING = [[10.0, 50.0], [11.0, 50.0], [11.0, 51.0], [10.0, 51.0], [10.0, 50.0]]
+# much smaller than a pixel of a 600x550 map showing BIG_RING
+TINY_RING = [[10.5, 50.5], [10.5000001, 50.5], [10.5000001, 50.5000001], [10.5, 50.5]]
+
+
+def test_simplify_polygons_drops_sub_pixel_ring():
+    polygons = simplify_polygons([BIG_RING, TINY_RING], 600, 550)
+
+    assert polygons == [tuple(tuple(point) for point in BIG_RING)]
+
+
+def test_multipolygon_with_sub_pixel_ring_can_be_added_to_map():
+    geojson = {'features': [{'geometry': {'type': 'MultiPolygon',
+                                          'coordinates': [[BIG_RING], [TINY_RING]]}}]}
+    context = staticmaps.Context()
+
+    _add_polygons_to_context(geojson, context, 600, 550)
+
+    assert len(context._objects) == 1
+
+
+def test_read_cache_file_treats_concurrently_removed_file_as_miss(tmp_path, monkeypatch):
+    cache_file = tmp_path / 'tile.png'
+    cache_file.write_bytes(b'tile')
+
+    def remove_and_read(path):
+        path.unlink()
+        return path.read_bytes()
+
+    # the cache cleanup removes the file between the age check and reading it
+    monkeypatch.setattr(Path, 'read_bytes', remove_and_read)
+
+    assert read_cache_file(cache_file, 3600) is None